@@ -1,6 +1,9 @@
 import os
 import sys
 import json
+import time
+import asyncio
+import threading
 import traceback
 from pymilvus import connections, FieldSchema, CollectionSchema, DataType,\
       Collection, utility, Partition
@@ -22,7 +25,7 @@ from src.utils.log_handler import debug_logger
 from src.utils.general_utils import get_time, cur_func_name
 from src.configs.configs import MILVUS_HOST_LOCAL, MILVUS_PORT, VECTOR_SEARCH_TOP_K
 
-from src.client.embedding.embedding_client import SBIEmbeddings, _process_query, embed_user_input
+from src.client.embedding.embedding_client import SBIEmbeddings, _process_query, embed_user_input, get_embeddings
 
 
 class MilvusFailed(Exception):
@@ -36,9 +39,18 @@ class MilvusClient:
         self.port = MILVUS_PORT
         self.sess: Collection = None
         self.partitions: List[Partition] = []
-        # 可以先不用
+        # 检索和写入在这个线程池中执行（asearch_docs / astore_docs），不阻塞事件循环
         self.executor = ThreadPoolExecutor(max_workers=4)
         self.top_k = VECTOR_SEARCH_TOP_K
+        # store_docs 每次 insert 的行数
+        self.insert_batch_size = 1000
+        # 已加载集合的缓存：user_id -> {'collection', 'partitions'(分区名集合), 'refreshed_at'}
+        # 只有第一次加载时访问 has_collection/load，查询时不再请求集合和分区的元数据
+        self._collections = {}
+        self._collections_lock = threading.Lock()
+        self._loading_locks = {}
+        # 要访问的分区不在缓存中时（例如其他进程的入库worker新建了分区），最多每隔这么多秒刷新一次分区列表
+        self.partition_refresh_interval = 10
         self.search_params = {"metric_type": "L2", "params": {"nprobe": 128}}
         self.create_params = {"metric_type": "L2", "index_type": "IVF_FLAT", "params": {"nlist": 1024}}
         # self.create_params = {"metric_type": "L2", "index_type": "GPU_IVF_FLAT", "params": {"nlist": 1024}}  # GPU版本
@@ -51,8 +63,29 @@ class MilvusClient:
         except Exception as e:
             debug_logger.error(f'[{cur_func_name()}] [MilvusClient] traceback = {traceback.format_exc()}')
 
+    def get_collection(self, user_id: str) -> Collection:
+        """
+        获取用户的集合句柄（线程安全），第一次访问时创建并加载集合
+
+        每个用户一把锁，加载某个用户的集合时不会阻塞其他用户已缓存集合的访问。
+        """
+        entry = self._collections.get(user_id)
+        if entry is None:
+            with self._collections_lock:
+                lock = self._loading_locks.setdefault(user_id, threading.Lock())
+            with lock:
+                entry = self._collections.get(user_id)
+                if entry is None:
+                    entry = self._load_collection(user_id)
+                    self._collections[user_id] = entry
+        return entry['collection']
+
     @get_time 
     def load_collection_(self, user_id):
+        """兼容旧接口：把用户的集合设为当前集合 self.sess，并发场景请使用 get_collection 并显式传入 collection"""
+        self.sess = self.get_collection(user_id)
+
+    def _load_collection(self, user_id):
         if not utility.has_collection(user_id):
             schema = CollectionSchema(self.fields)
             debug_logger.info(f'create collection {user_id}')
@@ -62,80 +95,154 @@ class MilvusClient:
         else:
             collection = Collection(user_id)
         collection.load()
-        self.sess = collection
-        
-    def store_doc(self, doc: Document, embedding: List[float]):
+        debug_logger.info(f'load collection {user_id}')
+        return {'collection': collection, 'partitions': {p.name for p in collection.partitions},
+                'refreshed_at': time.monotonic()}
+
+    def invalidate_collection(self, user_id: str):
+        """删除集合的缓存，新建、删除知识库（分区）或集合后调用，下次访问时重新加载"""
+        with self._collections_lock:
+            self._collections.pop(user_id, None)
+
+    def _resolve(self, collection: Collection = None) -> Collection:
+        collection = collection or self.sess
+        if not collection:
+            raise MilvusFailed("Milvus collection is not loaded. Call load_collection_() first.")
+        return collection
+
+    def get_partition_names(self, kb_ids: List[str] = None, collection: Collection = None) -> set:
+        """
+        集合的分区名（缓存），collection为空时使用当前集合
+
+        kb_ids 中有分区不在缓存中时，距离上次刷新超过 partition_refresh_interval 秒才重新查询分区列表。
         """
-        将文档块存储到 Milvus 中。
+        collection = self._resolve(collection)
+        entry = self._collections.get(collection.name)
+        if entry is None or entry['collection'] is not collection:
+            return {p.name for p in collection.partitions}
+        if kb_ids and not set(kb_ids) <= entry['partitions'] and \
+                time.monotonic() - entry['refreshed_at'] > self.partition_refresh_interval:
+            entry['partitions'] = {p.name for p in collection.partitions}
+            entry['refreshed_at'] = time.monotonic()
+        return entry['partitions']
+
+    def ensure_partitions(self, kb_ids: List[str], collection: Collection = None):
+        """确保集合中存在这些分区（使用kb_id作为分区标识），分区列表使用缓存，缺少的分区一次性创建"""
+        collection = self._resolve(collection)
+        existing_partitions = self.get_partition_names(kb_ids, collection)
+        for kb_id in kb_ids:
+            if kb_id in existing_partitions:
+                continue
+            try:
+                collection.create_partition(kb_id)
+                existing_partitions.add(kb_id)
+                debug_logger.info(f"Created new partition: {kb_id}")
+            except Exception as e:
+                debug_logger.error(f"Failed to create partition: {str(e)}")
+                raise MilvusFailed(f"Failed to create partition: {str(e)}")
+
+    def store_docs(self, docs: List[Document], embeddings, batch_size: int = None, flush: bool = False,
+                   collection: Collection = None) -> int:
+        """
+        批量将文档块存储到 Milvus 中，返回写入的数量。
+
+        缺少的分区在写入前统一创建，之后按分区（kb_id）把数据组织成列式数据，
+        每 batch_size 行调用一次 insert，避免每个文档块都查询分区列表、单行写入。
 
         Args:
-            doc (Document): Langchain 的 Document 对象，包含文档内容及其元数据。
-            embedding (List[float]): 文档的向量表示，长度为 768。
+            docs (List[Document]): Langchain 的 Document 对象列表。
+            embeddings: 每个文档块的向量，List[List[float]] 或者二维的 numpy 数组。
+            batch_size (int): 每次 insert 的行数，默认为 insert_batch_size。
+            flush (bool): 写入完成后是否 flush，把数据落盘成封存的段。
+            collection (Collection): 写入的集合（get_collection 获取），为空时使用当前集合。
         """
         try:
             # 确保 Milvus 集合已加载
-            if not self.sess:
-                raise MilvusFailed("Milvus collection is not loaded. Call load_collection_() first.")
-
-            # 提取文档元数据
-            metadata = doc.metadata
-            user_id = metadata.get('user_id')
-            kb_id = metadata.get('kb_id')
-            file_id = metadata.get('file_id')
-            headers = json.dumps(metadata.get('headers', {}))  # 将 headers 转换为 JSON 字符串
-            doc_id = metadata.get('doc_id')
-            content = doc.page_content
-
-            # 检查字段是否完整
-            if not all([user_id, kb_id, file_id, doc_id, content, embedding]):
-                raise MilvusFailed("Missing required fields in document metadata or embedding.")
-
-            # 构造插入数据（不需要提供主键值）
-            data = [
-                [user_id],  # user_id
-                [kb_id],    # kb_id
-                [file_id],  # file_id
-                [headers],  # headers
-                [doc_id],   # doc_id
-                [content],  # content
-                [embedding]  # embedding
-            ]
-                    # 分区名称（使用kb_id作为分区标识）
-
-            # 检查分区是否存在，如果不存在则创建
-            existing_partitions = set(self.sess.partitions)
-            if kb_id not in [p.name for p in existing_partitions]:
-                try:
-                    self.sess.create_partition(kb_id)
-                    print(f"Created new partition: {kb_id}")
-                except Exception as e:
-                    print(f"Failed to create partition: {str(e)}")
-                    raise MilvusFailed(f"Failed to create partition: {str(e)}")
-            # 插入数据到 Milvus
-            self.sess.insert(data, partition_name=kb_id)
-            print(f"Document {doc_id} stored successfully in collection {user_id} partition {kb_id}.")
+            collection = self._resolve(collection)
+            if len(docs) != len(embeddings):
+                raise MilvusFailed(f"Number of documents ({len(docs)}) and embeddings ({len(embeddings)}) mismatch.")
+            if not docs:
+                return 0
+            if hasattr(embeddings, 'tolist'):
+                embeddings = embeddings.tolist()
+            batch_size = batch_size or self.insert_batch_size
+            start_time = time.perf_counter()
+
+            # 按分区构造列式数据：user_id, kb_id, file_id, headers, doc_id, content, embedding
+            partitions = {}
+            for doc, embedding in zip(docs, embeddings):
+                metadata = doc.metadata
+                user_id = metadata.get('user_id')
+                kb_id = metadata.get('kb_id')
+                file_id = metadata.get('file_id')
+                headers = json.dumps(metadata.get('headers', {}))  # 将 headers 转换为 JSON 字符串
+                doc_id = metadata.get('doc_id')
+                content = doc.page_content
+                # 检查字段是否完整
+                if not all([user_id, kb_id, file_id, doc_id, content, embedding]):
+                    raise MilvusFailed(f"Missing required fields in document metadata or embedding: {doc_id}")
+                columns = partitions.setdefault(kb_id, [[] for _ in range(7)])
+                for column, value in zip(columns, (user_id, kb_id, file_id, headers, doc_id, content, embedding)):
+                    column.append(value)
+
+            self.ensure_partitions(list(partitions), collection)
+            # 插入数据到 Milvus（不需要提供主键值）
+            for kb_id, columns in partitions.items():
+                for i in range(0, len(columns[0]), batch_size):
+                    collection.insert([column[i:i + batch_size] for column in columns], partition_name=kb_id)
+            if flush:
+                collection.flush()
+            cost = time.perf_counter() - start_time
+            debug_logger.info(f"store {len(docs)} docs in collection {collection.name} partitions {list(partitions)}, "
+                              f"cost: {cost:.3f}s, {len(docs) / max(cost, 1e-9):.1f} rows/s")
+            return len(docs)
 
         except Exception as e:
-            print(f'[{cur_func_name()}] [store_doc] Failed to store document: {traceback.format_exc()}')
-            raise MilvusFailed(f"Failed to store document: {str(e)}")
+            debug_logger.error(f'[{cur_func_name()}] [store_docs] Failed to store documents: {traceback.format_exc()}')
+            raise MilvusFailed(f"Failed to store documents: {str(e)}")
 
     @get_time
-    def search_docs(self, query: str = None, filter_expr: str = None, doc_limit: int = 10, kb_ids: List[str] = None, search_all_partitions: bool = False) -> List[Document]:
+    def search_docs(self, query: str = None, filter_expr: str = None, doc_limit: int = 10, kb_ids: List[str] = None, search_all_partitions: bool = False,
+                    collection: Collection = None, query_embedding: List[float] = None) -> List[Document]:
         """
         从 Milvus 集合中检索文档。
 
         Args:
-            query_embedding (List[float]): 查询向量，用于基于向量相似性检索。
+            query (str): 查询文本，没有传入 query_embedding 时同步向量化（有缓存）。
             filter_expr (str): 过滤条件表达式，用于基于字段值的过滤。如"user_id == 'abc1234'"
             limit (int): 返回的文档数量上限，默认为 10。
+            collection (Collection): 检索的集合（get_collection 获取），为空时使用当前集合。
+            query_embedding (List[float]): 预先计算好的查询向量，用于基于向量相似性检索。
 
         Returns:
-            List[dict]: 检索到的文档列表，每个文档是一个字典，包含字段值和向量。
+            List[Document]: 检索到的文档列表。
+        """
+        if query_embedding is None:
+            try:
+                query_embedding = embed_user_input(query)
+            except Exception as e:
+                raise MilvusFailed(f"Failed to embed query: {str(e)}")
+        return self.search_docs_batch([query_embedding], filter_expr, doc_limit, kb_ids, search_all_partitions,
+                                      collection)[0]
+
+    def search_docs_batch(self, query_embeddings, filter_expr: str = None, doc_limit: int = 10,
+                          kb_ids: List[str] = None, search_all_partitions: bool = False,
+                          collection: Collection = None) -> List[List[Document]]:
+        """
+        用一批查询向量在一次 search 调用中检索，返回每个查询向量各自的文档列表。
+
+        Args:
+            query_embeddings: 查询向量，List[List[float]] 或者二维的 numpy 数组。
+            其余参数同 search_docs。
         """
         try:
-            query_embedding = embed_user_input(query)
-            if not self.sess:
-                raise MilvusFailed("Milvus collection is not loaded. Call load_collection_() first.")
+            collection = self._resolve(collection)
+            if hasattr(query_embeddings, 'tolist'):
+                query_embeddings = query_embeddings.tolist()
+            query_embeddings = [embedding.tolist() if hasattr(embedding, 'tolist') else embedding
+                                for embedding in query_embeddings]
+            if not query_embeddings:
+                return []
 
             # 构造查询参数
             search_params = {
@@ -145,10 +252,8 @@ class MilvusClient:
             partition_names = []
             if not search_all_partitions:
                 if kb_ids:
-                    # 获取所有现有分区
-                    existing_partitions = list(self.sess.partitions)
-                    # print(existing_partitions)
-                    existing_partitions = [p.name for p in existing_partitions]           
+                    # 获取所有现有分区（缓存）
+                    existing_partitions = self.get_partition_names(kb_ids, collection)
                     # 构造要搜索的分区名称列表
                     partition_names = [kb_id for kb_id in kb_ids]
 
@@ -173,7 +278,7 @@ class MilvusClient:
 
             # 构造检索参数
             search_params.update({
-                "data": [query_embedding] if query_embedding else None,
+                "data": query_embeddings,
                 "anns_field": "embedding", # 指定集合中存储向量的字段名称。Milvus 会在该字段上进行向量相似性检索。
                 "param": {"metric_type": "L2", "params": {"nprobe": 128}}, # 检索的精度和性能
                 "limit": doc_limit, # 指定返回的最相似文档的数量上限
@@ -183,10 +288,11 @@ class MilvusClient:
             })
 
             # 执行检索
-            results = self.sess.search(**search_params)
-            # 处理检索结果
-            retrieved_docs = []
+            results = collection.search(**search_params)
+            # 处理检索结果，每个查询向量一个列表
+            retrieved_docs_list = []
             for hits in results:
+                retrieved_docs = []
                 for hit in hits:
                     doc = Document(hit.entity.get("content"))
                     doc.metadata["user_id"] = hit.entity.get("user_id")
@@ -197,13 +303,64 @@ class MilvusClient:
                     # doc.metadata["embedding"] = hit.entity.get("embedding")
                     doc.metadata["distance"] =  hit.distance
                     retrieved_docs.append(doc)
+                retrieved_docs_list.append(retrieved_docs)
 
-            return retrieved_docs
+            return retrieved_docs_list
 
         except Exception as e:
             print(f'[{cur_func_name()}] [search_docs] Failed to search documents: {traceback.format_exc()}')
+            # 集合可能已经在其他地方被删除或释放，丢弃缓存，下次重新加载
+            if collection and not isinstance(e, MilvusFailed):
+                self.invalidate_collection(collection.name)
             raise MilvusFailed(f"Failed to search documents: {str(e)}")
 
+    def delete_file_docs(self, file_id: str, collection: Collection = None):
+        """删除集合中某个文件的全部文档块，入库前调用，清理上次失败或重复领取时写入的数据"""
+        self._resolve(collection).delete(expr=f'file_id == "{file_id}"')
+
+    async def asearch_docs(self, user_id: str, query: str = None, filter_expr: str = None, doc_limit: int = 10,
+                           kb_ids: List[str] = None, search_all_partitions: bool = False,
+                           query_embedding: List[float] = None, collection: Collection = None) -> List[Document]:
+        """
+        在线程池中检索用户的集合，不阻塞事件循环，不同用户的检索可以并行执行
+
+        没有传入 query_embedding 时先通过共用的embedding客户端异步向量化（有缓存），
+        线程池中只执行milvus的检索。已经用 get_collection 获取了集合时可以通过 collection 传入。
+        """
+        loop = asyncio.get_running_loop()
+        if query_embedding is None:
+            query_embedding = await get_embeddings().aembed_query(query)
+
+        def search():
+            return self.search_docs(query, filter_expr, doc_limit, kb_ids, search_all_partitions,
+                                    collection=collection or self.get_collection(user_id),
+                                    query_embedding=query_embedding)
+
+        return await loop.run_in_executor(self.executor, search)
+
+    async def asearch_docs_batch(self, user_id: str, query_embeddings, filter_expr: str = None, doc_limit: int = 10,
+                                 kb_ids: List[str] = None, search_all_partitions: bool = False,
+                                 collection: Collection = None) -> List[List[Document]]:
+        """在线程池中用一批查询向量检索用户的集合，一次 search 调用，返回每个查询向量各自的文档列表"""
+        loop = asyncio.get_running_loop()
+
+        def search():
+            return self.search_docs_batch(query_embeddings, filter_expr, doc_limit, kb_ids, search_all_partitions,
+                                          collection=collection or self.get_collection(user_id))
+
+        return await loop.run_in_executor(self.executor, search)
+
+    async def astore_docs(self, user_id: str, docs: List[Document], embeddings, batch_size: int = None,
+                          flush: bool = False, collection: Collection = None) -> int:
+        """在线程池中把文档块写入用户的集合，collection 已经取到时直接传入，不再重复获取"""
+        loop = asyncio.get_running_loop()
+
+        def store():
+            return self.store_docs(docs, embeddings, batch_size, flush,
+                                   collection=collection or self.get_collection(user_id))
+
+        return await loop.run_in_executor(self.executor, store)
+
     @property
     def fields(self):
         fields = [
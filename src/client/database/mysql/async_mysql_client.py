@@ -0,0 +1,208 @@
+import os
+import sys
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+root_dir = os.path.dirname(root_dir)
+sys.path.append(root_dir)
+from src.configs.configs import (MYSQL_HOST_LOCAL, MYSQL_PORT_LOCAL, MYSQL_USER_LOCAL,
+                                 MYSQL_PASSWORD_LOCAL, MYSQL_DATABASE_LOCAL)
+from src.utils.log_handler import debug_logger
+import aiomysql
+import asyncio
+import json
+import time
+import uuid
+
+
+class AsyncMysqlClient:
+    """
+    异步的mysql访问层，给API服务的请求处理函数使用
+
+    和 MysqlClient 使用同一套表结构（建表和索引仍由 MysqlClient 在启动时完成），
+    基于 aiomysql 的连接池，查询时不阻塞事件循环，并发的问答请求不会在数据库IO上排队。
+    连接池在第一次查询时创建，绑定当时的事件循环（每个sanic worker一个）。
+    连接开启autocommit，读查询不会停留在旧的事务快照里，看不到其他进程后来提交的修改。
+    同时统计等待连接池的时间和查询耗时。
+    """
+
+    def __init__(self, minsize: int = 1, maxsize: int = 16):
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.pool = None
+        self._init_lock = None
+        # 统计信息
+        self.queries = 0
+        self.errors = 0
+        self.waiting = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_query_time = 0.0
+        self.max_query_time = 0.0
+
+    async def init(self):
+        if self.pool is not None:
+            return
+        if self._init_lock is None:
+            self._init_lock = asyncio.Lock()
+        async with self._init_lock:
+            if self.pool is None:
+                self.pool = await aiomysql.create_pool(host=MYSQL_HOST_LOCAL, port=int(MYSQL_PORT_LOCAL),
+                                                       user=MYSQL_USER_LOCAL, password=MYSQL_PASSWORD_LOCAL,
+                                                       db=MYSQL_DATABASE_LOCAL, charset='utf8mb4',
+                                                       minsize=self.minsize, maxsize=self.maxsize,
+                                                       autocommit=True)
+                debug_logger.info(f"AsyncMysqlClient pool created, minsize: {self.minsize}, maxsize: {self.maxsize}")
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+    async def execute_query_(self, query, params, commit=False, fetch=False, check=False, user_dict=False):
+        """参数和返回值同 MysqlClient.execute_query_，出错时记录日志并返回None"""
+        await self.init()
+        start_time = time.perf_counter()
+        self.waiting += 1
+        try:
+            conn = await self.pool.acquire()
+        except Exception as err:
+            self.waiting -= 1
+            self.errors += 1
+            debug_logger.error("从连接池获取连接失败：{}".format(err))
+            return None
+        self.waiting -= 1
+        acquired_time = time.perf_counter()
+        wait_time = acquired_time - start_time
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        result = None
+        try:
+            cursor_class = aiomysql.DictCursor if user_dict else aiomysql.Cursor
+            async with conn.cursor(cursor_class) as cursor:
+                await cursor.execute(query, params)
+                if commit:
+                    await conn.commit()
+                if fetch:
+                    result = await cursor.fetchall()
+                elif check:
+                    result = cursor.rowcount
+        except Exception as err:
+            self.errors += 1
+            debug_logger.error("执行数据库操作失败：{}，SQL：{}".format(err, query))
+            if commit:
+                await conn.rollback()
+        finally:
+            self.pool.release(conn)
+            query_time = time.perf_counter() - acquired_time
+            self.queries += 1
+            self.total_query_time += query_time
+            self.max_query_time = max(self.max_query_time, query_time)
+        return result
+
+    def stats(self) -> dict:
+        queries = max(self.queries, 1)
+        return {"pool_size": self.pool.size if self.pool is not None else 0,
+                "pool_free": self.pool.freesize if self.pool is not None else 0,
+                "maxsize": self.maxsize, "queries": self.queries, "errors": self.errors, "waiting": self.waiting,
+                "avg_wait_time": round(self.total_wait_time / queries, 4), "max_wait_time": round(self.max_wait_time, 4),
+                "avg_query_time": round(self.total_query_time / queries, 4),
+                "max_query_time": round(self.max_query_time, 4)}
+
+    # 检查知识库是否存在，返回不存在的kb_id
+    async def check_kb_exist(self, user_id, kb_ids):
+        if not kb_ids:
+            return []
+        placeholders = ','.join(['%s'] * len(kb_ids))
+        query = "SELECT kb_id FROM KnowledgeBase WHERE kb_id IN ({}) AND deleted = 0 AND user_id = %s".format(
+            placeholders)
+        result = await self.execute_query_(query, list(kb_ids) + [user_id], fetch=True) or []
+        valid_kb_ids = [kb_info[0] for kb_info in result]
+        return list(set(kb_ids) - set(valid_kb_ids))
+
+    # 检查用户是否存在
+    async def check_user_exist_(self, user_id):
+        query = "SELECT user_id FROM User WHERE user_id = %s"
+        result = await self.execute_query_(query, (user_id,), fetch=True)
+        return result is not None and len(result) > 0
+
+    async def add_user_(self, user_id, user_name):
+        query = "INSERT IGNORE INTO User (user_id, user_name) VALUES (%s, %s)"
+        await self.execute_query_(query, (user_id, user_name), commit=True)
+        debug_logger.info(f"Add user: {user_id} {user_name}")
+
+    # 创建新的知识库
+    async def new_milvus_base(self, kb_id, user_id, kb_name, user_name=None):
+        if not await self.check_user_exist_(user_id):
+            await self.add_user_(user_id, user_name)
+        query = "INSERT INTO KnowledgeBase (kb_id, user_id, kb_name) VALUES (%s, %s, %s)"
+        await self.execute_query_(query, (kb_id, user_id, kb_name), commit=True)
+        return kb_id, "success"
+
+    # 获取知识库中的文件，返回的字段同 MysqlClient.get_files
+    async def get_files(self, user_id, kb_id, file_id=None):
+        query = """
+            SELECT file_id, file_name, status, file_size, content_length, timestamp,
+                file_location, file_url, chunk_size, msg
+            FROM File
+            WHERE user_id = %s AND kb_id = %s AND deleted = 0
+        """
+        params = [user_id, kb_id]
+        if file_id is not None:
+            query += " AND file_id = %s"
+            params.append(file_id)
+        return await self.execute_query_(query, params, fetch=True) or []
+
+    # 查看文件是否存在
+    async def check_file_exist_by_name(self, user_id, kb_id, file_names):
+        results = []
+        batch_size = 100
+        for i in range(0, len(file_names), batch_size):
+            batch_file_names = file_names[i:i + batch_size]
+            placeholders = ','.join(['%s'] * len(batch_file_names))
+            query = """
+                SELECT file_id, file_name, file_size, status FROM File
+                WHERE deleted = 0
+                AND file_name IN ({})
+                AND kb_id = %s
+                AND kb_id IN (SELECT kb_id FROM KnowledgeBase WHERE user_id = %s)
+            """.format(placeholders)
+            batch_result = await self.execute_query_(query, batch_file_names + [kb_id, user_id], fetch=True)
+            results.extend(batch_result or [])
+        return results
+
+    # 获取知识库名字
+    async def get_knowledge_base_name(self, kb_ids):
+        placeholders = ','.join(['%s'] * len(kb_ids))
+        query = "SELECT user_id, kb_id, kb_name FROM KnowledgeBase WHERE kb_id IN ({}) AND deleted = 0".format(
+            placeholders)
+        return await self.execute_query_(query, list(kb_ids), fetch=True)
+
+    # [文件] 向指定知识库下面增加文件
+    async def add_file(self, file_id, user_id, kb_id, file_name, file_size, file_location, chunk_size, timestamp,
+                       file_url='', status="green"):
+        query = ("INSERT INTO File (file_id, user_id, kb_id, file_name, status, file_size, file_location, chunk_size, "
+                 "timestamp, file_url) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        await self.execute_query_(query, (file_id, user_id, kb_id, file_name, status, file_size, file_location,
+                                          chunk_size, timestamp, file_url), commit=True)
+
+    # [文件] 添加 chunks number 字段
+    async def modify_file_chunks_number(self, file_id, user_id, kb_id, chunks_number):
+        query = "UPDATE File SET chunks_number = %s WHERE file_id = %s AND user_id = %s AND kb_id = %s"
+        await self.execute_query_(query, (chunks_number, file_id, user_id, kb_id), commit=True)
+
+    # [问答日志] 记录一次问答，字段说明见 MysqlClient.create_tables_ 中的 QaLogs 表
+    async def add_qalog(self, user_id, kb_ids, query, model, product_source, time_record, history, condense_question,
+                        prompt, result, retrieval_documents, source_documents):
+        sql = ("INSERT INTO QaLogs (qa_id, user_id, kb_ids, query, model, product_source, time_record, history, "
+               "condense_question, prompt, result, retrieval_documents, source_documents) "
+               "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        params = ('QA' + uuid.uuid4().hex, user_id, json.dumps(kb_ids, ensure_ascii=False), query, model,
+                  product_source, json.dumps(time_record, ensure_ascii=False),
+                  json.dumps(history, ensure_ascii=False), condense_question, prompt, result,
+                  json.dumps(retrieval_documents, ensure_ascii=False), json.dumps(source_documents, ensure_ascii=False))
+        await self.execute_query_(sql, params, commit=True)
@@ -11,9 +11,11 @@ from src.configs.configs import (MYSQL_HOST_LOCAL, MYSQL_PORT_LOCAL, MYSQL_USER_
                                                    MYSQL_PASSWORD_LOCAL,
                                                    MYSQL_DATABASE_LOCAL, KB_SUFFIX, MILVUS_HOST_LOCAL)
 from src.utils.log_handler import debug_logger, insert_logger
+from src.utils.cache_utils import LRUCache
 import mysql.connector
 from mysql.connector import pooling
 import json
+import time
 from typing import List, Optional, Dict
 import uuid
 from datetime import datetime, timedelta
@@ -38,6 +40,12 @@ class MysqlClient:
         self.cnxpool = pooling.MySQLConnectionPool(pool_size=pool_size, pool_reset_session=True, **dbconfig)
         self.free_cnx = pool_size
         self.used_cnx = 0
+        # 文件是否已删除的缓存（file_id -> bool），以及每个知识库已删除文件的缓存（kb_id -> frozenset）
+        # 文件的删除标记由其他进程写入，缓存ttl秒后过期，删除最多延迟ttl秒生效
+        self.deleted_file_cache = LRUCache(100000, ttl=60)
+        self.kb_deleted_files_cache = LRUCache(4096, ttl=60)
+        # 批量写入时每次 executemany 的行数
+        self.bulk_batch_size = 500
         self.create_tables_()
         debug_logger.info("[SUCCESS] 数据库{}连接成功".format(database))    
 
@@ -98,6 +106,8 @@ class MysqlClient:
         except MySQLError as err:
             if err.errno == 1061:
                 debug_logger.info(f"Index already exists (this is okay): {query}")
+            elif err.errno == 1060:
+                debug_logger.info(f"Column already exists (this is okay): {query}")
             else:
                 debug_logger.error("执行数据库操作失败：{}，SQL：{}".format(err, query))
             if commit:
@@ -113,6 +123,35 @@ class MysqlClient:
                     self.free_cnx, self.used_cnx))
 
         return result
+
+    def execute_many_(self, query, params_list, batch_size):
+        """
+        用 executemany 按 batch_size 行一批执行同一条语句，所有批在同一个事务中提交
+
+        和 execute_query_ 不同，出错时回滚后把异常抛给调用方，避免批量写入只成功一部分而调用方不知道。
+        """
+        if not params_list:
+            return
+        conn = self.cnxpool.get_connection()
+        self.used_cnx += 1
+        self.free_cnx -= 1
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            for i in range(0, len(params_list), batch_size):
+                cursor.executemany(query, params_list[i:i + batch_size])
+            conn.commit()
+        except MySQLError as err:
+            debug_logger.error("批量执行数据库操作失败：{}，SQL：{}".format(err, query))
+            conn.rollback()
+            raise
+        finally:
+            if cursor is not None:
+                cursor.close()
+            conn.close()
+            self.used_cnx -= 1
+            self.free_cnx += 1
+
     # 数据库建表语句
     def create_tables_(self):
         query = """
@@ -156,7 +195,10 @@ class MysqlClient:
                 file_url VARCHAR(2048) DEFAULT '',
                 upload_infos TEXT,
                 chunk_size INT DEFAULT -1,
-                timestamp VARCHAR(255) DEFAULT '197001010000'
+                timestamp VARCHAR(255) DEFAULT '197001010000',
+                retry_count INT DEFAULT 0,
+                worker_id VARCHAR(255) DEFAULT NULL,
+                claimed_at DATETIME DEFAULT NULL
             );
 
         """
@@ -246,6 +288,11 @@ class MysqlClient:
             "CREATE INDEX idx_user_id_status ON File (user_id, status)",
             "CREATE INDEX index_query ON QaLogs (query)",
             "CREATE INDEX index_timestamp ON QaLogs (timestamp)",
+            # 后台入库队列需要的字段，兼容已有的File表
+            "ALTER TABLE File ADD COLUMN retry_count INT DEFAULT 0",
+            "ALTER TABLE File ADD COLUMN worker_id VARCHAR(255) DEFAULT NULL",
+            "ALTER TABLE File ADD COLUMN claimed_at DATETIME DEFAULT NULL",
+            "CREATE INDEX idx_status_deleted ON File (status, deleted)",
         ]
 
         for query in index_queries:
@@ -396,12 +443,20 @@ class MysqlClient:
         query = ("UPDATE File SET chunks_number = %s WHERE file_id = %s AND user_id = %s AND kb_id = %s")
         self.execute_query_(query, (chunks_number, file_id, user_id, kb_id), commit=True)
 
-    def store_parent_chunks(self, docs):
+    def store_parent_chunks(self, docs, batch_size=None):
+        """
+        批量写入一个文件的全部父块，返回写入的数量
+
+        JSON序列化在拿连接之前完成（调用方在线程池中调用），之后用 executemany 按 batch_size 行
+        一批写入，所有批在同一个事务中，只提交一次，出错时整体回滚并抛出异常。
+        """
         query = """
             INSERT INTO Documents (doc_id, json_data)
             VALUES (%s, %s)
             ON DUPLICATE KEY UPDATE json_data = VALUES(json_data)
         """
+        start_time = time.perf_counter()
+        params_list = []
         for (id,doc) in docs:
             # 构造要存储的JSON数据
             doc_data = {
@@ -410,12 +465,124 @@ class MysqlClient:
             }
             # 将数据转换为JSON字符串
             json_data = json.dumps(doc_data, ensure_ascii=False)
-            self.execute_query_(query, (id, json_data), commit=True)
+            params_list.append((id, json_data))
+        serialize_time = time.perf_counter() - start_time
+        self.execute_many_(query, params_list, batch_size or self.bulk_batch_size)
+        cost = time.perf_counter() - start_time
+        insert_logger.info(f"store {len(params_list)} parent chunks, serialize: {serialize_time:.3f}s, "
+                           f"total: {cost:.3f}s, {len(params_list) / max(cost, 1e-9):.1f} rows/s")
+        return len(params_list)
     
+    # [入库队列] 文件状态：gray 等待入库，yellow 入库中，green 入库成功，red 入库失败
+    def claim_file(self, worker_id):
+        """
+        从队列中领取一个等待入库的文件，没有时返回None
+
+        用 UPDATE ... LIMIT 1 原子地把一个gray文件改为yellow并记录worker_id，
+        多个worker同时领取时不会拿到同一个文件。
+        """
+        query = ("UPDATE File SET status = 'yellow', worker_id = %s, claimed_at = NOW() "
+                 "WHERE status = 'gray' AND deleted = 0 ORDER BY id LIMIT 1")
+        if not self.execute_query_(query, (worker_id,), commit=True, check=True):
+            return None
+        query = ("SELECT file_id, user_id, kb_id, file_name, file_location, chunk_size, retry_count FROM File "
+                 "WHERE worker_id = %s AND status = 'yellow' ORDER BY claimed_at DESC LIMIT 1")
+        result = self.execute_query_(query, (worker_id,), fetch=True, user_dict=True)
+        return result[0] if result else None
+
+    def update_file_status(self, file_id, status, msg='success', worker_id=None):
+        """
+        更新文件状态，返回更新的行数
+
+        传入worker_id时只有文件仍然被这个worker领取着才更新，文件超时后被放回队列、
+        由其他worker重新领取时，原来的worker不会覆盖新的状态。
+        """
+        query = "UPDATE File SET status = %s, msg = %s, worker_id = NULL WHERE file_id = %s"
+        params = [status, msg[:255], file_id]
+        if worker_id is not None:
+            query += " AND worker_id = %s"
+            params.append(worker_id)
+        return self.execute_query_(query, params, commit=True, check=True)
+
+    def retry_or_fail_file(self, file_id, msg, max_retries, worker_id=None):
+        """
+        入库失败时重试次数加一，没超过max_retries时放回队列（gray），否则标记为失败（red），返回更新的行数
+
+        worker_id的含义同 update_file_status
+        """
+        query = ("UPDATE File SET status = IF(retry_count + 1 >= %s, 'red', 'gray'), "
+                 "retry_count = retry_count + 1, msg = %s, worker_id = NULL WHERE file_id = %s")
+        params = [max_retries, msg[:255], file_id]
+        if worker_id is not None:
+            query += " AND worker_id = %s"
+            params.append(worker_id)
+        return self.execute_query_(query, params, commit=True, check=True)
+
+    def touch_file(self, file_id, worker_id):
+        """入库期间定期刷新领取时间（心跳），处理时间长的文件不会被当作超时放回队列，返回文件是否仍被这个worker领取"""
+        query = "UPDATE File SET claimed_at = NOW() WHERE file_id = %s AND worker_id = %s AND status = 'yellow'"
+        return bool(self.execute_query_(query, (file_id, worker_id), commit=True, check=True))
+
+    def reset_stale_files(self, timeout):
+        """把领取超过timeout秒还没完成的文件（worker崩溃或重启）放回队列，返回重置的数量"""
+        query = ("UPDATE File SET status = 'gray', worker_id = NULL "
+                 "WHERE status = 'yellow' AND deleted = 0 AND claimed_at < NOW() - INTERVAL %s SECOND")
+        return self.execute_query_(query, (int(timeout),), commit=True, check=True)
+
     def is_deleted_file(self, file_id):
-        query = "SELECT deleted FROM File WHERE file_id = %s"
-        result = self.execute_query_(query, (file_id,), fetch=True)
-        if result:
-            return result[0][0] == 1
-        else:
-            return False
\ No newline at end of file
+        return file_id in self.get_deleted_file_ids([file_id])
+
+    # [文件] 批量查询已删除的文件，结果缓存在进程内
+    def get_deleted_file_ids(self, file_ids):
+        """
+        返回 file_ids 中已删除的文件，缓存未命中的文件用一次 IN 查询
+
+        数据库中不存在的文件视为未删除，和 is_deleted_file 原来的行为一致。
+        """
+        file_ids = list(dict.fromkeys(file_ids))
+        deleted = set()
+        missing = []
+        for file_id in file_ids:
+            is_deleted = self.deleted_file_cache.get(file_id)
+            if is_deleted is None:
+                missing.append(file_id)
+            elif is_deleted:
+                deleted.add(file_id)
+        if missing:
+            placeholders = ','.join(['%s'] * len(missing))
+            query = "SELECT file_id, deleted FROM File WHERE file_id IN ({})".format(placeholders)
+            result = self.execute_query_(query, missing, fetch=True)
+            if result is None:
+                # 查询失败时不缓存，按未删除处理
+                return deleted
+            status = {file_id: is_deleted == 1 for file_id, is_deleted in result}
+            for file_id in missing:
+                is_deleted = status.get(file_id, False)
+                self.deleted_file_cache.put(file_id, is_deleted)
+                if is_deleted:
+                    deleted.add(file_id)
+        return deleted
+
+    def get_deleted_file_ids_in_kbs(self, kb_ids):
+        """返回这些知识库中所有已删除的文件，按知识库缓存，用于在检索时直接排除"""
+        deleted = set()
+        missing = []
+        for kb_id in kb_ids:
+            kb_deleted = self.kb_deleted_files_cache.get(kb_id)
+            if kb_deleted is None:
+                missing.append(kb_id)
+            else:
+                deleted |= kb_deleted
+        if missing:
+            placeholders = ','.join(['%s'] * len(missing))
+            query = "SELECT kb_id, file_id FROM File WHERE kb_id IN ({}) AND deleted = 1".format(placeholders)
+            result = self.execute_query_(query, missing, fetch=True)
+            if result is None:
+                return deleted
+            kb_deleted = {kb_id: set() for kb_id in missing}
+            for kb_id, file_id in result:
+                kb_deleted[kb_id].add(file_id)
+            for kb_id, file_ids in kb_deleted.items():
+                self.kb_deleted_files_cache.put(kb_id, frozenset(file_ids))
+                deleted |= file_ids
+        return deleted
@@ -14,10 +14,13 @@ from src.utils.log_handler import debug_logger, embed_logger
 from src.utils.general_utils import get_time_async, get_time
 from langchain_core.embeddings import Embeddings
 from src.configs.configs import LOCAL_EMBED_SERVICE_URL, LOCAL_RERANK_BATCH
+from src.utils.embedding_codec import BINARY_DTYPES, BINARY_CONTENT_TYPE, decode_embeddings
+from src.client.http_pool import get_model_service_pool
+from src.utils.cache_utils import LRUCache, text_hash
+import numpy as np
 import traceback
-import aiohttp
 import asyncio
-import requests
+import threading
 
 # 清除多余换行以及以![figure]和![equation]起始的行
 def _process_query(query):
@@ -28,48 +31,87 @@ def _process_query(query):
 
 class SBIEmbeddings(Embeddings):
     # 初始化请求embedding服务的url
-    def __init__(self):
+    # encoding为float32/float16时请求二进制格式的响应，为json时使用原来的json格式
+    # query_cache_size 为查询向量缓存的条目数，为0时不缓存
+    def __init__(self, encoding: str = 'float32', query_cache_size: int = 4096, query_cache_ttl: float = 3600):
         self.url = f"http://{LOCAL_EMBED_SERVICE_URL}/embedding"
-        self.session = requests.Session()
+        # 进程内共用的长连接池，同步和异步请求都带重试
+        self.pool = get_model_service_pool()
+        self.session = self.pool.sync_session
+        if encoding != 'json' and encoding not in BINARY_DTYPES:
+            raise ValueError(f"unsupported embedding encoding: {encoding}")
+        self.encoding = encoding
+        # 查询向量缓存，key为预处理后查询文本的hash，同一个问题在多个分区检索、重试时只向量化一次
+        self.query_cache = LRUCache(query_cache_size, ttl=query_cache_ttl) if query_cache_size > 0 else None
         super().__init__()
-    # 异步向embedding服务请求获取文本的向量
-    async def _get_embedding_async(self, session, texts):
+
+    def _build_request(self, texts):
         # 去除多余换行和特殊标记
         data = {'texts': [_process_query(text) for text in texts]}
-        async with session.post(self.url, json=data) as response:
-            return await response.json()
+        if self.encoding != 'json':
+            data['encoding'] = self.encoding
+        return data
 
-    @get_time_async
-    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+    # 异步向embedding服务请求获取文本的向量
+    async def _get_embedding_async(self, texts) -> np.ndarray:
+        async with self.pool.post(self.url, json=self._build_request(texts)) as response:
+            response.raise_for_status()
+            # 旧版本的服务不认识encoding参数，仍然返回json，这里按响应类型解析
+            if response.content_type == BINARY_CONTENT_TYPE:
+                return decode_embeddings(await response.read(), response.headers)
+            return np.asarray(await response.json(), dtype=np.float32)
+
+    async def aembed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """异步获取文本向量，直接返回 (n, dim) 的numpy矩阵"""
         # 设置批量大小
         batch_size = LOCAL_RERANK_BATCH 
         # 向上取整
         embed_logger.info(f'embedding texts number: {len(texts) / batch_size}')
         all_embeddings = []
         # 分批请求获取文本向量
-        async with aiohttp.ClientSession() as session:
-            tasks = [self._get_embedding_async(session, texts[i:i + batch_size])
-                     for i in range(0, len(texts), batch_size)]
-            # 收集所有任务结果，
-            # asyncio.gather 的一个重要特性是：虽然任务是并发执行的，但返回结果时会保持跟任务列表相同的顺序。
-            # 即使后面的批次先处理完，最终 results 中的顺序仍然与 tasks 列表的顺序一致。
-            results = await asyncio.gather(*tasks)
-            # 合并所有任务结果
-            for result in results:
-                all_embeddings.extend(result)
+        tasks = [self._get_embedding_async(texts[i:i + batch_size])
+                 for i in range(0, len(texts), batch_size)]
+        # 收集所有任务结果，
+        # asyncio.gather 的一个重要特性是：虽然任务是并发执行的，但返回结果时会保持跟任务列表相同的顺序。
+        # 即使后面的批次先处理完，最终 results 中的顺序仍然与 tasks 列表的顺序一致。
+        results = await asyncio.gather(*tasks)
+        # 合并所有任务结果
+        all_embeddings = [result for result in results if len(result)]
+        all_embeddings = np.concatenate(all_embeddings, axis=0) if all_embeddings else np.empty((0, 0), np.float32)
         debug_logger.info(f'success embedding number: {len(all_embeddings)}')
         # 返回结果
         return all_embeddings
+
+    @get_time_async
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return (await self.aembed_documents_array(texts)).tolist()
+    async def aembed_queries_array(self, texts: List[str]) -> np.ndarray:
+        """异步获取查询向量，返回 (n, dim) 的numpy矩阵，命中缓存的查询不再请求，未命中的合并成一次请求"""
+        if self.query_cache is None:
+            return await self.aembed_documents_array(texts)
+        keys = [text_hash(_process_query(text)) for text in texts]
+        vectors = [self.query_cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embeddings = await self.aembed_documents_array([texts[i] for i in missing])
+            for i, embedding in zip(missing, embeddings):
+                # 复制一份，缓存中不保留整个批次的矩阵
+                vectors[i] = embedding = embedding.copy()
+                self.query_cache.put(keys[i], embedding)
+        return np.stack(vectors) if vectors else np.empty((0, 0), np.float32)
+
     # 专门用于处理单个查询文本。将单个text转换为列表，因为是单个所以只取第一条embedding向量
     async def aembed_query(self, text: str) -> List[float]:
-        return (await self.aembed_documents([text]))[0]
+        return (await self.aembed_queries_array([text]))[0].tolist()
     # 同步方法
     def _get_embedding_sync(self, texts):
         # 为什么同步去除，异步没去除标记啊，我先都给加上
-        data = {'texts': [_process_query(text) for text in texts]}
+        data = self._build_request(texts)
         try:
             response = self.session.post(self.url, json=data)
             response.raise_for_status()
+            if response.headers.get('Content-Type', '').startswith(BINARY_CONTENT_TYPE):
+                return decode_embeddings(response.content, response.headers).tolist()
             result = response.json()
             return result
         except Exception as e:
@@ -86,7 +128,29 @@ class SBIEmbeddings(Embeddings):
     def embed_query(self, text: str) -> List[float]:
         """Embed query text."""
         # return self._get_embedding([text])['embeddings'][0]
-        return self._get_embedding_sync([text])[0]
+        key = text_hash(_process_query(text)) if self.query_cache is not None else None
+        if key is not None:
+            vector = self.query_cache.get(key)
+            if vector is not None:
+                return vector.tolist()
+        embedding = self._get_embedding_sync([text])[0]
+        if key is not None:
+            self.query_cache.put(key, np.asarray(embedding, dtype=np.float32))
+        return embedding
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings() -> SBIEmbeddings:
+    """获取当前进程共用的embedding客户端，查询向量缓存在所有调用方之间共享"""
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                _embeddings = SBIEmbeddings()
+    return _embeddings
+
 
 async def test_async_methods():
     """测试异步方法"""
@@ -181,23 +245,22 @@ async def performance_test():
         debug_logger.info(f"异步处理 {size} 个文本耗时: {async_time:.2f}秒")
 
 def embed_user_input(user_input: str):
-    """测试用户输入的文本嵌入"""
-    embedder = SBIEmbeddings()
+    """同步获取用户输入的查询向量，使用进程内共用的客户端和查询向量缓存"""
+    embedder = get_embeddings()
     
     # 对用户输入的文本进行预处理
     processed_input = _process_query(user_input)
     
-    debug_logger.info("\n测试用户输入的嵌入:")
-    debug_logger.info(f"用户输入: {user_input}")
-    debug_logger.info(f"预处理后的输入: {processed_input}")
+    debug_logger.debug(f"用户输入: {user_input}")
+    debug_logger.debug(f"预处理后的输入: {processed_input}")
     
     try:
         # 使用同步方法获取嵌入向量
         embedding = embedder.embed_query(processed_input)
-        debug_logger.info(f"嵌入向量维度: {len(embedding)}")
-        debug_logger.info(f"嵌入向量: {embedding}")
+        debug_logger.debug(f"嵌入向量维度: {len(embedding)}")
     except Exception as e:
         debug_logger.error(f"嵌入过程中发生错误: {str(e)}")
+        raise
 
     return embedding
 
@@ -0,0 +1,181 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from src.utils.log_handler import debug_logger
+
+# 这些状态码说明模型服务暂时不可用（503为推理队列已满），可以重试
+RETRY_STATUS = (500, 502, 503, 504)
+
+
+def create_retry_session(retries: int, backoff_factor: float, pool_maxsize: int = 10,
+                         retry_post: bool = False) -> requests.Session:
+    """
+    创建一个带有重试机制的 requests Session
+
+    参数：
+    retries: int - 重试次数
+    backoff_factor: float - 重试间隔因子
+    pool_maxsize: int - 每个host保持的最大连接数
+    retry_post: bool - 是否重试POST，默认只重试幂等的请求，模型服务的POST接口可以安全重试
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=list(RETRY_STATUS),
+        allowed_methods=None if retry_post else Retry.DEFAULT_ALLOWED_METHODS,
+    )
+    # 创建适配器并设置重试策略
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+
+    # 将适配器挂载到会话上，分别处理 http 和 https
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class ModelServicePool:
+    """
+    访问embedding、rerank等模型服务的长连接池，每个进程（sanic worker）一个
+
+    异步请求共用一个 aiohttp.ClientSession，连接保持keep-alive，按host限制连接数，
+    并用信号量限制同时在途的请求数；连接错误、超时和 RETRY_STATUS 按指数退避重试。
+    同步请求共用一个带重试的 requests.Session。
+    aiohttp的session绑定创建它的事件循环，事件循环变化时（例如脚本里多次 asyncio.run）会关闭旧的session后重新创建。
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 32, max_concurrency: int = 64,
+                 retries: int = 3, backoff_factor: float = 0.5, timeout: float = 300,
+                 keepalive_timeout: float = 60):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop = None
+        self._sync_session: Optional[requests.Session] = None
+        self._sync_lock = threading.Lock()
+        # 统计信息
+        self.calls = 0
+        self.requests = 0
+        self.retried = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.sessions_created = 0
+        self.total_latency = 0.0
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._session
+        if session is None or session.closed or self._loop is not loop:
+            old_session = session
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            # 先替换再关闭旧的session，关闭期间并发的请求直接使用新的session
+            self._session = session
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+            self.sessions_created += 1
+            if old_session is not None and not old_session.closed:
+                # 旧的session属于之前的事件循环，关闭它的连接器，不再保留其中的keep-alive连接
+                try:
+                    await old_session.close()
+                except Exception as e:
+                    debug_logger.warning(f"close stale aiohttp session failed: {e!r}")
+        return session
+
+    @property
+    def sync_session(self) -> requests.Session:
+        if self._sync_session is None:
+            with self._sync_lock:
+                if self._sync_session is None:
+                    self._sync_session = create_retry_session(self.retries, self.backoff_factor,
+                                                              pool_maxsize=self.limit_per_host, retry_post=True)
+        return self._sync_session
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """
+        发送请求，返回的response在with块内有效（流式响应可以在块内逐行读取）
+
+        可重试的错误在返回response之前重试，重试用完后抛出最后一次的异常，
+        状态码仍然可重试时返回最后一次的response，由调用方决定如何处理。
+        """
+        session = await self._get_session()
+        self.waiting += 1
+        async with self._semaphore:
+            self.waiting -= 1
+            self.in_flight += 1
+            self.calls += 1
+            start_time = time.perf_counter()
+            try:
+                for attempt in range(self.retries + 1):
+                    self.requests += 1
+                    try:
+                        response = await session.request(method, url, **kwargs)
+                    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                        if attempt >= self.retries:
+                            self.failed += 1
+                            raise
+                        debug_logger.warning(f"request {url} failed: {e!r}, retry {attempt + 1}/{self.retries}")
+                    else:
+                        if response.status not in RETRY_STATUS or attempt >= self.retries:
+                            break
+                        debug_logger.warning(f"request {url} status {response.status}, "
+                                             f"retry {attempt + 1}/{self.retries}")
+                        response.release()
+                    self.retried += 1
+                    await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                try:
+                    yield response
+                finally:
+                    response.release()
+            finally:
+                self.in_flight -= 1
+                self.total_latency += time.perf_counter() - start_time
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> dict:
+        connector = self._session.connector if self._session is not None and not self._session.closed else None
+        return {"limit": self.limit, "limit_per_host": self.limit_per_host,
+                "max_concurrency": self.max_concurrency,
+                "calls": self.calls, "requests": self.requests, "retried": self.retried, "failed": self.failed,
+                "in_flight": self.in_flight, "waiting": self.waiting,
+                "sessions_created": self.sessions_created,
+                "avg_latency": round(self.total_latency / max(self.calls, 1), 4),
+                "connector_closed": connector is None or connector.closed}
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        if self._sync_session is not None:
+            self._sync_session.close()
+
+
+_pool: Optional[ModelServicePool] = None
+
+
+def get_model_service_pool() -> ModelServicePool:
+    """获取当前进程共用的模型服务连接池"""
+    global _pool
+    if _pool is None:
+        _pool = ModelServicePool()
+    return _pool
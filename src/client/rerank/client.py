@@ -9,59 +9,99 @@ root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(curre
 
 sys.path.append(root_dir)
 
-from typing import List
+from typing import AsyncGenerator, List
 from src.utils.log_handler import debug_logger
 from src.utils.general_utils import get_time_async, get_time
 from src.configs.configs import LOCAL_RERANK_BATCH,LOCAL_RERANK_SERVICE_URL
+from src.client.http_pool import get_model_service_pool
 from langchain.schema import Document
 import traceback
-import aiohttp
+import json
 import asyncio
-import requests
 
 
 class SBIRerank:
     def __init__(self):
         """初始化重排序客户端"""
         self.url = f"http://{LOCAL_RERANK_SERVICE_URL}/rerank"
+        self.topk_url = f"http://{LOCAL_RERANK_SERVICE_URL}/rerank_topk"
+        self.stream_url = f"http://{LOCAL_RERANK_SERVICE_URL}/rerank_stream"
+        # 进程内共用的长连接池，同步和异步请求都带重试
+        self.pool = get_model_service_pool()
         # 不支持异步的session
-        self.session = requests.Session()
-
-    async def _get_rerank_async(self, query: str, passages: List[str]) -> List[float]:
-        """异步请求重排序服务"""
-        data = {'query': query, 'passages': passages}
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.url, json=data) as response:
-                    return await response.json()
-        except Exception as e:
-            debug_logger.error(f'async rerank error: {traceback.format_exc()}')
-            return [0.0] * len(passages)
+        self.session = self.pool.sync_session
 
     @get_time_async
     async def arerank_documents(self, query: str, source_documents: List[Document]) -> List[Document]:
-        """Embed search docs using async calls, maintaining the original order."""
-        batch_size = LOCAL_RERANK_BATCH  # 增大客户端批处理大小
-        all_scores = [0 for _ in range(len(source_documents))]
-        passages = [doc.page_content for doc in source_documents]
-
-        tasks = []
-        for i in range(0, len(passages), batch_size):
-            task = asyncio.create_task(self._get_rerank_async(query, passages[i:i + batch_size]))
-            tasks.append((i, task))
-
-        for start_index, task in tasks:
-            res = await task
-            if res is None:
-                return source_documents
-            all_scores[start_index:start_index + batch_size] = res
+        """
+        对所有文档重排序，按分数从高到低返回
 
-        for idx, score in enumerate(all_scores):
-            source_documents[idx].metadata['score'] = round(float(score), 2)
-        source_documents = sorted(source_documents, key=lambda x: x.metadata['score'], reverse=True)
-
-        return source_documents
+        通过流式接口请求，各块按完成的顺序到达，不会因为按提交顺序等待而被最慢的块挡住。
+        请求失败时所有文档分数记为0。
+        """
+        reranked_documents = []
+        try:
+            async for docs in self.astream_rerank_documents(query, source_documents):
+                reranked_documents.extend(docs)
+        except Exception:
+            debug_logger.error(f'async rerank error: {traceback.format_exc()}')
+            for doc in source_documents:
+                doc.metadata['score'] = 0.0
+            return source_documents
+        return sorted(reranked_documents, key=lambda x: x.metadata['score'], reverse=True)
 
+    @get_time_async
+    async def arerank_topk(self, query: str, source_documents: List[Document], top_k: int,
+                           score_threshold: float = 0.0, relative_threshold: float = None,
+                           exact_scores: bool = True) -> List[Document]:
+        """
+        top-k感知的重排序，只返回过滤后保留的文档，按分数从高到低排序
+
+        exact_scores 为False时，服务端不再计算已经确定会被保留的长文档剩余的窗口，这些文档返回的分数是下界
+        （不低于 max(score_threshold, 1 - relative_threshold)）。原来的检索分数作为hints一起发给服务端，
+        服务端按hints的顺序推理。
+        """
+        data = {'query': query, 'passages': [doc.page_content for doc in source_documents], 'top_k': top_k,
+                'score_threshold': score_threshold, 'relative_threshold': relative_threshold,
+                'exact_scores': exact_scores,
+                'hints': [float(doc.metadata.get('score', 0)) for doc in source_documents]}
+        async with self.pool.post(self.topk_url, json=data) as response:
+            response.raise_for_status()
+            results = await response.json()
+        reranked_documents = []
+        for item in results:
+            doc = source_documents[item['index']]
+            doc.metadata['score'] = round(float(item['score']), 2)
+            reranked_documents.append(doc)
+        return reranked_documents
+
+    async def astream_rerank_documents(self, query: str, source_documents: List[Document],
+                                       chunk_size: int = LOCAL_RERANK_BATCH) -> AsyncGenerator[List[Document], None]:
+        """
+        流式重排序，服务端每算完一块就返回一块
+
+        每次yield一块已经打好分的文档（块内按分数从高到低排序），块的顺序是完成的顺序。
+        调用方可以在高分的块到达后就开始过滤、拼接prompt，不用等所有块都算完。
+        推理失败的块分数记为0。
+        """
+        data = {'query': query, 'passages': [doc.page_content for doc in source_documents],
+                'chunk_size': chunk_size}
+        async with self.pool.post(self.stream_url, json=data) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                start = result['start']
+                docs = source_documents[start:start + chunk_size]
+                if 'error' in result:
+                    debug_logger.error(f"stream rerank chunk {start} error: {result['error']}")
+                    scores = [0.0] * len(docs)
+                else:
+                    scores = result['scores']
+                for doc, score in zip(docs, scores):
+                    doc.metadata['score'] = round(float(score), 2)
+                yield sorted(docs, key=lambda x: x.metadata['score'], reverse=True)
 
 
 #使用示例
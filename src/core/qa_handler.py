@@ -1,23 +1,25 @@
 
 from src.configs.configs import VECTOR_SEARCH_SCORE_THRESHOLD, CUSTOM_PROMPT_TEMPLATE, \
     SYSTEM, PROMPT_TEMPLATE, INSTRUCTIONS, SIMPLE_PROMPT_TEMPLATE, \
-    QUERY_REWRITE_ENABLED, QUERY_REWRITE_TARGET_LANG
+    QUERY_REWRITE_ENABLED, QUERY_REWRITE_TARGET_LANG, \
+    HYBRID_FUSION_METHOD, HYBRID_FUSION_MILVUS_WEIGHT, HYBRID_FUSION_ES_WEIGHT
 from src.utils.general_utils import deduplicate_documents, num_tokens, num_tokens_rerank, my_print, replace_image_references
 from src.core.chains.condense_q_chain import RewriteQuestionChain
 from src.client.llm.llm_client import OpenAILLM
 from src.core.query_rewrite.pipeline import QueryRewritePipeline
 from langchain.schema import Document
 from langchain.schema.messages import AIMessage, HumanMessage
-from urllib3.util import Retry
-from requests.adapters import HTTPAdapter
-import requests
+from src.client.http_pool import create_retry_session
 from src.core.retriever.retriever import Retriever
 from src.client.database.elasticsearch.es_client import ESClient
 from src.client.database.milvus.milvus_client import MilvusClient
 from src.client.database.mysql.mysql_client import MysqlClient
+from src.client.database.mysql.async_mysql_client import AsyncMysqlClient
+from src.core.file_handler.file_handler import FileHandler
 from src.utils.log_handler import debug_logger
 from src.client.rerank.client import SBIRerank
-from src.client.embedding.embedding_client import SBIEmbeddings
+from src.client.embedding.embedding_client import SBIEmbeddings, get_embeddings
+import asyncio
 import json
 import re
 import sys
@@ -46,6 +48,17 @@ class QAHandler:
         self.milvus_summary: MysqlClient = None
         self.es_client: ESClient = None
         self.session = self.create_retry_session(retries=3, backoff_factor=1)
+        # 上传文件入库时每批向量化的chunk数，以及同时在途的向量化批数
+        self.ingest_batch_size = 64
+        self.ingest_concurrency = 4
+        # 开启查询重写时，用原始、翻译、重写后的多个查询一起检索，结果用RRF融合
+        self.multi_query_retrieval = True
+        # 检索时在milvus expr/es filter中排除的已删除文件数上限，超过时只在检索后过滤
+        self.max_excluded_files = 1000
+        # rerank后的过滤：先保留分数>=rerank_score_threshold的文档（都不满足时不过滤），
+        # 再去掉比最高分低rerank_relative_threshold以上的；相对阈值为None时使用流式rerank
+        self.rerank_score_threshold = 0.28
+        self.rerank_relative_threshold = 0.5
         # self.doc_splitter = CharacterTextSplitter(
         #     chunk_size=LOCAL_EMBED_MAX_LENGTH / 2,
         #     chunk_overlap=0,
@@ -61,51 +74,130 @@ class QAHandler:
         retries: int - 重试次数
         backoff_factor: float - 重试间隔因子
         """
-        session = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=[500, 502, 503, 504],
-        )
-        # 创建适配器并设置重试策略
-        adapter = HTTPAdapter(max_retries=retry)
-
-        # 将适配器挂载到会话上，分别处理 http 和 https
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
+        return create_retry_session(retries, backoff_factor)
 
     def init_cfg(self, args=None):
-        self.embeddings = SBIEmbeddings()
+        # 进程内共用的embedding客户端，和检索共享查询向量缓存
+        self.embeddings = get_embeddings()
         self.rerank = SBIRerank()
         self.mysql_client = MysqlClient()
+        # 请求处理和入库中使用的异步mysql访问层，表结构由上面的 MysqlClient 创建
+        self.async_mysql_client = AsyncMysqlClient()
         self.milvus_client = MilvusClient()
         self.es_client = ESClient()
-        self.retriever = Retriever()
+        self.retriever = Retriever(fusion_method=HYBRID_FUSION_METHOD, milvus_weight=HYBRID_FUSION_MILVUS_WEIGHT,
+                                   es_weight=HYBRID_FUSION_ES_WEIGHT)
         # 初始化query_rewrite pipeline
         if QUERY_REWRITE_ENABLED:
             self.query_rewrite_pipeline = QueryRewritePipeline()
         else:
             self.query_rewrite_pipeline = None
 
-    async def get_source_documents(self, query, retriever: Retriever, kb_ids, time_record, hybrid_search, top_k):
+    async def aembed_and_store_docs(self, user_id: str, docs: List[Document]) -> int:
+        """
+        批量向量化文档块并写入milvus，返回写入的数量
+
+        文档块按 ingest_batch_size 分批，通过异步接口向量化，最多 ingest_concurrency 批同时在途；
+        milvus的写入放到 milvus_client 的线程池中按批顺序执行，写入第i批的同时继续向量化后面的批，
+        整个过程不阻塞事件循环。
+        """
+        if not docs:
+            return 0
+        loop = asyncio.get_running_loop()
+        collection = await loop.run_in_executor(self.milvus_client.executor, self.milvus_client.get_collection,
+                                                user_id)
+        semaphore = asyncio.Semaphore(self.ingest_concurrency)
+
+        async def embed_batch(batch):
+            async with semaphore:
+                return await self.embeddings.aembed_documents_array([doc.page_content for doc in batch])
+
+        batches = [docs[i:i + self.ingest_batch_size] for i in range(0, len(docs), self.ingest_batch_size)]
+        embed_tasks = [asyncio.create_task(embed_batch(batch)) for batch in batches]
+        stored = 0
+        insert_future = None
+        try:
+            for batch, task in zip(batches, embed_tasks):
+                embeddings = await task
+                if len(embeddings) != len(batch):
+                    raise RuntimeError(f"embedding number mismatch: {len(embeddings)} != {len(batch)}")
+                # 上一批写完再提交这一批，保证写入顺序，同时后面的批还在向量化
+                if insert_future is not None:
+                    stored += await insert_future
+                insert_future = asyncio.ensure_future(
+                    self.milvus_client.astore_docs(user_id, batch, embeddings, collection=collection))
+            stored += await insert_future
+        finally:
+            for task in embed_tasks:
+                task.cancel()
+        debug_logger.info(f"embed and store {stored} docs in {len(batches)} batches")
+        return stored
+
+    async def ingest_file(self, file_id: str, user_id: str, kb_id: str, file_name: str, file_location: str,
+                          chunk_size: int) -> int:
+        """
+        解析、切分一个已上传的文件，向量化后写入milvus和es，父块写入mysql，返回父块数量
+
+        由后台入库worker调用。写入前总是先删除这个文件在milvus中已有的数据（milvus主键自增，
+        上次失败、超时被放回队列或者被重复领取时写入的数据都会被清掉），
+        es和mysql按doc_id覆盖写入，重复执行不会产生重复数据。
+        """
+        loop = asyncio.get_running_loop()
+        kb_name = (await self.async_mysql_client.get_knowledge_base_name([kb_id]))[0][2]
+        file_handler = FileHandler(user_id, kb_name, kb_id, file_id, file_location, file_name, chunk_size)
+        # 文件解析和切分都是CPU密集的同步操作，放到线程池中执行，不阻塞事件循环
+        await loop.run_in_executor(None, file_handler.split_file_to_docs)
+        # 切父块800 没重叠  切子块400 重叠部分100
+        file_handler.docs, full_docs = await loop.run_in_executor(None, FileHandler.split_docs, file_handler.docs)
+        parent_chunk_number = len(set(doc.metadata["doc_id"] for doc in file_handler.docs))
+        collection = await loop.run_in_executor(self.milvus_client.executor, self.milvus_client.get_collection,
+                                                user_id)
+        await loop.run_in_executor(self.milvus_client.executor, self.milvus_client.delete_file_docs, file_id,
+                                   collection)
+        # 向量化和milvus写入流水线执行
+        await self.aembed_and_store_docs(user_id, file_handler.docs)
+        # 将切分好的子块存入es数据库中
+        if self.es_client is not None:
+            try:
+                # docs的doc_id是file_id + '_' + i，是es数据库中的唯一标识，而不是父块编号
+                docs_ids = [doc.metadata['file_id'] + '_' + str(i) for i, doc in enumerate(file_handler.docs)]
+                es_res = await self.es_client.es_store.aadd_documents(file_handler.docs, ids=docs_ids)
+                debug_logger.info(f'es_store insert number: {len(es_res)}, {es_res[0]}')
+            except Exception:
+                debug_logger.error(f"Error in aadd_documents on es_store: {traceback.format_exc()}")
+        # 将切好的父doc批量存入mysql数据库中（线程池中序列化，一个事务写入），并更新文件的chunk number
+        await loop.run_in_executor(None, self.mysql_client.store_parent_chunks, full_docs)
+        await self.async_mysql_client.modify_file_chunks_number(file_id, user_id, kb_id, parent_chunk_number)
+        return parent_chunk_number
+
+    async def get_source_documents(self, query, retriever: Retriever, kb_ids, time_record, hybrid_search, top_k,
+                                   user_id=None, query_variants=None):
         source_documents = []
         start_time = time.perf_counter()
-        query_docs = await retriever.get_retrieved_documents(query, self.milvus_client, self.es_client, partition_keys=kb_ids, time_record=time_record,
-                                                             hybrid_search=hybrid_search, top_k=top_k)
+        loop = asyncio.get_running_loop()
+        # 知识库中已删除的文件（有缓存）在检索时直接排除，太多时只在检索后过滤
+        deleted_file_ids = await loop.run_in_executor(None, self.mysql_client.get_deleted_file_ids_in_kbs, kb_ids)
+        exclude_file_ids = sorted(deleted_file_ids) if len(deleted_file_ids) <= self.max_excluded_files else None
+        es_store = self.es_client.es_store if self.es_client is not None else None
+        query_docs = await retriever.get_retrieved_documents(query, self.milvus_client, es_store, partition_keys=kb_ids, time_record=time_record,
+                                                             hybrid_search=hybrid_search, top_k=top_k, user_id=user_id,
+                                                             query_variants=query_variants,
+                                                             exclude_file_ids=exclude_file_ids)
         end_time = time.perf_counter()
         time_record['retriever_search'] = round(end_time - start_time, 2)
         debug_logger.info(
             f"retriever_search time: {time_record['retriever_search']}s")
         # debug_logger.info(f"query_docs num: {len(query_docs)}, query_docs: {query_docs}")
+        # 检索期间可能有文件被删除，检索结果再用一次批量查询（有缓存）过滤
+        deleted_file_ids |= await loop.run_in_executor(None, self.mysql_client.get_deleted_file_ids,
+                                                       [doc.metadata['file_id'] for doc in query_docs])
         for idx, doc in enumerate(query_docs):
-            if self.mysql_client.is_deleted_file(doc.metadata['file_id']):
+            if doc.metadata['file_id'] in deleted_file_ids:
                 debug_logger.warning(
                     f"file_id: {doc.metadata['file_id']} is deleted")
                 continue
             doc.metadata['retrieval_query'] = query  # 添加查询到文档的元数据中
+            # 混合检索融合后已经有融合分数，其他情况按检索排名给一个分数
             if 'score' not in doc.metadata:
                 doc.metadata['score'] = 1 - \
                     (idx / len(query_docs))  # TODO 这个score怎么获取呢
@@ -117,12 +209,12 @@ class QAHandler:
 
         return source_documents
 
-    def process_query_rewrite(self, query: str, time_record: dict) -> str:
+    def process_query_rewrite(self, query: str, time_record: dict) -> Tuple[str, List[str]]:
         """
-        简单的查询重写处理，返回处理后的查询
+        简单的查询重写处理，返回处理后的查询，以及用于多查询检索的全部查询变体（原始、翻译、重写）
         """
         if not self.query_rewrite_pipeline:
-            return query
+            return query, [query]
 
         try:
             t1 = time.perf_counter()
@@ -142,17 +234,20 @@ class QAHandler:
             debug_logger.info(
                 f"Original query: {query} -> Processed query: {processed_query}")
 
-            return processed_query
+            query_variants = [processed_query, query] + list(result.get('rewrites') or [])
+            return processed_query, query_variants
 
         except Exception as e:
             debug_logger.error(f"Query rewrite error: {e}")
             time_record['query_rewrite'] = 0.0
-            return query
+            return query, [query]
 
     def reprocess_source_documents(self, custom_llm: OpenAILLM, query: str,
                                    source_docs: List[Document],
                                    history: List[str],
-                                   prompt_template: str) -> Tuple[List[Document], int, str]:
+                                   prompt_template: str,
+                                   doc_token_nums: dict = None) -> Tuple[List[Document], int, str]:
+        """doc_token_nums 为提前算好的文档正文token数（见 count_doc_tokens），没有的文档在这里计算"""
         # 组装prompt,根据max_token
         query_token_num = int(custom_llm.num_tokens_from_messages([query]) * 4)
         history_token_num = int(custom_llm.num_tokens_from_messages(
@@ -192,6 +287,8 @@ class QAHandler:
         # if limited_token_nums < 200:
         #     return []
 
+        if doc_token_nums is None:
+            doc_token_nums = {}
         new_source_docs = []
         total_token_num = 0
         not_repeated_file_ids = []
@@ -205,10 +302,9 @@ class QAHandler:
                     headers = f"headers={doc.metadata['headers']}"
                     headers_token_num = custom_llm.num_tokens_from_messages([
                                                                             headers])
-            doc_valid_content = re.sub(
-                r'!\[figure]\(.*?\)', '', doc.page_content)
-            doc_token_num = custom_llm.num_tokens_from_messages(
-                [doc_valid_content])
+            doc_token_num = doc_token_nums.get(id(doc))
+            if doc_token_num is None:
+                doc_token_num = self.count_doc_tokens(custom_llm, [doc])[id(doc)]
             doc_token_num += headers_token_num
             if total_token_num + doc_token_num <= limited_token_nums:
                 new_source_docs.append(doc)
@@ -221,6 +317,36 @@ class QAHandler:
         # 返回新的doc列表，给doc剩余的token数量，token计算的信息
         return new_source_docs, limited_token_nums, tokens_msg
 
+    @staticmethod
+    def count_doc_tokens(custom_llm: OpenAILLM, docs: List[Document]) -> dict:
+        """计算文档正文（去掉图片引用）拼进prompt时的token数，返回 {id(doc): token数}"""
+        return {id(doc): custom_llm.num_tokens_from_messages([re.sub(r'!\[figure]\(.*?\)', '', doc.page_content)])
+                for doc in docs}
+
+    async def astream_rerank(self, custom_llm: OpenAILLM, query: str, source_documents: List[Document],
+                             top_k: int) -> Tuple[List[Document], dict]:
+        """
+        流式rerank，返回 (过滤后的文档, 文档正文的token数)
+
+        rerank服务每算完一块就返回一块，收到一块后马上在线程池中计算这一块文档拼接prompt时要用的token数，
+        和其余块的推理重叠。所有块到达后按分数排序，保留分数>=rerank_score_threshold的文档（都不满足时不过滤），
+        取前top_k个。没有相对阈值时使用，相对阈值需要所有分数都算完才能确定过滤线。
+        """
+        loop = asyncio.get_running_loop()
+        reranked_documents = []
+        token_tasks = []
+        async for docs in self.rerank.astream_rerank_documents(query, source_documents):
+            reranked_documents.extend(docs)
+            token_tasks.append(loop.run_in_executor(None, self.count_doc_tokens, custom_llm, docs))
+        doc_token_nums = {}
+        for token_nums in await asyncio.gather(*token_tasks):
+            doc_token_nums.update(token_nums)
+        reranked_documents.sort(key=lambda doc: doc.metadata['score'], reverse=True)
+        if any(doc.metadata['score'] >= self.rerank_score_threshold for doc in reranked_documents):
+            reranked_documents = [doc for doc in reranked_documents
+                                  if doc.metadata['score'] >= self.rerank_score_threshold]
+        return reranked_documents[:top_k], doc_token_nums
+
     @staticmethod
     async def generate_response(query, res, condense_question, source_documents, time_record, chat_history, streaming, prompt):
         """
@@ -340,7 +466,7 @@ class QAHandler:
                                          temperature, api_base, api_key, api_context_length, top_p, top_k, web_chunk_size,
                                          chat_history=None, streaming: bool = True, rerank: bool = False,
                                          only_need_search_results: bool = False, need_web_search=False,
-                                         hybrid_search=False):
+                                         hybrid_search=False, user_id=None):
         # 创建与大模型交互句柄
         custom_llm = OpenAILLM(model, max_token, api_base,
                                api_key, api_context_length, top_p, temperature)
@@ -350,12 +476,13 @@ class QAHandler:
         # 在最开始进行query_rewrite处理
         if QUERY_REWRITE_ENABLED and self.query_rewrite_pipeline:
             debug_logger.info("Processing query rewrite...")
-            processed_query = self.process_query_rewrite(query, time_record)
+            processed_query, query_variants = self.process_query_rewrite(query, time_record)
             retrieval_query = processed_query
             condense_question = processed_query
         else:
             retrieval_query = query
             condense_question = query
+            query_variants = [query]
         # 如果有对话历史就将对话历史和query结合进行query重写
         if chat_history:
             formatted_chat_history = []
@@ -409,7 +536,9 @@ class QAHandler:
         # 如果有kb_ids那么需要对重写后的查询进行向量检索
         if kb_ids:
             source_documents = await self.get_source_documents(retrieval_query, retriever, kb_ids, time_record,
-                                                               hybrid_search, top_k)
+                                                               hybrid_search, top_k, user_id=user_id,
+                                                               query_variants=query_variants
+                                                               if self.multi_query_retrieval else None)
         else:
             source_documents = []
         # 这里处理网络搜索
@@ -446,38 +575,28 @@ class QAHandler:
         # 对检索的内容进行rerank
         # 将检索内容进行去重
         source_documents = deduplicate_documents(source_documents)
+        doc_token_nums = None
         if rerank and len(source_documents) > 1 and num_tokens_rerank(query) <= 300:
             try:
                 t1 = time.perf_counter()
                 debug_logger.info(
                     f"use rerank, rerank docs num: {len(source_documents)}")
-                source_documents = await self.rerank.arerank_documents(condense_question, source_documents)
+                if self.rerank_relative_threshold is None:
+                    # 没有相对阈值时流式rerank，先到达的块在等待其余块时就开始计算拼接prompt要用的token数
+                    source_documents, doc_token_nums = await self.astream_rerank(custom_llm, condense_question,
+                                                                                 source_documents, top_k)
+                else:
+                    # 低分过滤和截断放到rerank服务里做。已经在top_k里并且某个窗口分数
+                    # >= max(score_threshold, 1 - relative_threshold)（一定能通过两个阈值）的长文档不再计算剩余的窗口，
+                    # 这些文档的分数是已算窗口的最高分，是最终分数的下界
+                    source_documents = await self.rerank.arerank_topk(
+                        condense_question, source_documents, top_k, score_threshold=self.rerank_score_threshold,
+                        relative_threshold=self.rerank_relative_threshold, exact_scores=False)
                 t2 = time.perf_counter()
                 time_record['rerank'] = round(t2 - t1, 2)
-                # 过滤掉低分的文档
-                debug_logger.info(f"rerank step1 num: {len(source_documents)}")
+                debug_logger.info(f"rerank num: {len(source_documents)}")
                 debug_logger.info(
-                    f"rerank step1 scores: {[doc.metadata['score'] for doc in source_documents]}")
-                if len(source_documents) > 1:
-                    # 如果没有大于等于0.28的分数则保留
-                    if filtered_documents := [doc for doc in source_documents if doc.metadata['score'] >= 0.28]:
-                        source_documents = filtered_documents
-                    debug_logger.info(
-                        f"rerank step2 num: {len(source_documents)}")
-                    saved_docs = [source_documents[0]]
-                    # 根据相对分数来过滤文档块
-                    for doc in source_documents[1:]:
-                        debug_logger.info(
-                            f"rerank doc score: {doc.metadata['score']}")
-                        relative_difference = (
-                            saved_docs[0].metadata['score'] - doc.metadata['score']) / saved_docs[0].metadata['score']
-                        if relative_difference > 0.5:
-                            break
-                        else:
-                            saved_docs.append(doc)
-                    source_documents = saved_docs
-                    debug_logger.info(
-                        f"rerank step3 num: {len(source_documents)}")
+                    f"rerank scores: {[doc.metadata['score'] for doc in source_documents]}")
             except Exception as e:
                 time_record['rerank'] = 0.0
                 debug_logger.error(
@@ -543,7 +662,8 @@ class QAHandler:
                                                                                                   query=query,
                                                                                                   source_docs=source_documents,
                                                                                                   history=chat_history,
-                                                                                                  prompt_template=prompt_template)
+                                                                                                  prompt_template=prompt_template,
+                                                                                                  doc_token_nums=doc_token_nums)
             if len(retrieval_documents) < len(source_documents):
                 # 重新处理后文档数量减少，说明由于tokens不足而被裁切
                 if len(retrieval_documents) == 0:  # 说明被裁切后文档数量为0
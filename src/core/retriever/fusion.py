@@ -0,0 +1,83 @@
+from typing import Hashable, List
+
+from langchain.schema import Document
+
+# RRF的平滑常数，常用取值60，越大排名靠后的结果权重衰减越慢
+RRF_K = 60
+
+
+def doc_key(doc: Document) -> Hashable:
+    """同一个文档块的标识，多个列表中的同一块只保留一份"""
+    return doc.metadata.get('doc_id'), doc.page_content
+
+
+def reciprocal_rank_fusion(doc_lists: List[List[Document]], k: int = RRF_K, top_n: int = None) -> List[Document]:
+    """
+    倒数排名融合（Reciprocal Rank Fusion）
+
+    每个文档块的融合分数为它在各个列表中排名的 1 / (k + rank) 之和（rank从1开始），
+    只依赖排名，不需要各个列表的分数在同一个尺度上。融合分数记在 metadata['rrf_score']，
+    同一块出现在多个列表中时保留第一次出现的Document。
+    """
+    scores = {}
+    docs = {}
+    for doc_list in doc_lists:
+        for rank, doc in enumerate(doc_list, start=1):
+            key = doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            docs.setdefault(key, doc)
+    fused = sorted(docs, key=lambda key: scores[key], reverse=True)
+    if top_n is not None:
+        fused = fused[:top_n]
+    for key in fused:
+        docs[key].metadata['rrf_score'] = round(scores[key], 6)
+    return [docs[key] for key in fused]
+
+
+def normalize_scores(scores: List[float], lower_is_better: bool = False) -> List[float]:
+    """
+    min-max归一化到[0, 1]，越大越相关
+
+    milvus返回的L2距离越小越相关，传 lower_is_better=True；es的BM25分数越大越相关。
+    所有分数相同时（包括只有一个结果）都记为1。
+    """
+    if not scores:
+        return []
+    low, high = min(scores), max(scores)
+    if high - low < 1e-12:
+        return [1.0] * len(scores)
+    if lower_is_better:
+        return [(high - score) / (high - low) for score in scores]
+    return [(score - low) / (high - low) for score in scores]
+
+
+def weighted_fusion(doc_lists: List[List[Document]], weights: List[float], method: str = 'rrf', k: int = RRF_K,
+                    top_n: int = None) -> List[Document]:
+    """
+    多路检索结果的加权融合，同一个文档块（doc_key）只保留一份
+
+    method为'rrf'时融合分数为各路的 weight / (k + rank) 之和，再除以可能的最大值 sum(weights) / (k + 1)；
+    为'convex'时为各路归一化分数 metadata['norm_score'] 的加权和，再除以 sum(weights)，某一路没有命中记为0。
+    两种方法的融合分数都在[0, 1]之间，记在 metadata['score']，按融合分数从高到低返回。
+    """
+    if method not in ('rrf', 'convex'):
+        raise ValueError(f"unsupported fusion method: {method}")
+    total_weight = sum(weights) or 1.0
+    scores = {}
+    docs = {}
+    for doc_list, weight in zip(doc_lists, weights):
+        for rank, doc in enumerate(doc_list, start=1):
+            key = doc_key(doc)
+            if method == 'rrf':
+                score = weight / (k + rank)
+            else:
+                score = weight * doc.metadata.get('norm_score', 0.0)
+            scores[key] = scores.get(key, 0.0) + score
+            docs.setdefault(key, doc)
+    max_score = total_weight / (k + 1) if method == 'rrf' else total_weight
+    fused = sorted(docs, key=lambda key: scores[key], reverse=True)
+    if top_n is not None:
+        fused = fused[:top_n]
+    for key in fused:
+        docs[key].metadata['score'] = round(scores[key] / max_score, 4)
+    return [docs[key] for key in fused]
@@ -9,32 +9,142 @@ root_dir = os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))
 root_dir = os.path.dirname(root_dir)
 sys.path.append(root_dir)
 import time
+import json
+import asyncio
+from langchain.schema import Document
 from src.utils.log_handler import debug_logger
 from src.client.database.milvus.milvus_client import MilvusClient
-from src.client.database.elasticsearch.es_client import ESClient
+from src.client.embedding.embedding_client import get_embeddings
+from src.core.retriever.fusion import reciprocal_rank_fusion, normalize_scores, weighted_fusion, RRF_K
+from langchain_elasticsearch import ElasticsearchStore
 
 class Retriever:
-    async def get_retrieved_documents(self, query: str, vector_store: MilvusClient, es_store: ESClient, partition_keys: List[str], time_record: dict,
-                                    hybrid_search: bool, top_k: int, expr: str = None):
-        milvus_start_time = time.perf_counter()
-        # TODO 把milvus搜索转为Document类型 
-        query_docs = vector_store.search_docs(query, expr, top_k, partition_keys)
-        for doc in query_docs:
+    def __init__(self, milvus_timeout: float = 10, es_timeout: float = 5, fusion_method: str = 'rrf',
+                 milvus_weight: float = 1.0, es_weight: float = 1.0):
+        # 混合检索时milvus和es并发执行，每个分支单独超时，超时或出错的分支返回空结果
+        self.milvus_timeout = milvus_timeout
+        self.es_timeout = es_timeout
+        # 混合检索结果的融合方式：'rrf' 加权倒数排名融合，'convex' 归一化分数的加权和，None 直接拼接（原来的方式）
+        self.fusion_method = fusion_method
+        self.milvus_weight = milvus_weight
+        self.es_weight = es_weight
+
+    async def search_milvus(self, query: str, vector_store: MilvusClient, partition_keys: List[str], top_k: int,
+                            expr: str = None, user_id: str = None, query_variants: List[str] = None,
+                            collection=None) -> List[Document]:
+        # 去重后的查询变体（原始、翻译、重写等），第一个是query本身
+        variants = list(dict.fromkeys([query] + [q for q in (query_variants or []) if q]))
+        norm_scores = None
+        if user_id and len(variants) > 1:
+            # 多查询检索：所有变体一次请求批量向量化，一次milvus检索，结果用RRF融合
+            query_embeddings = await get_embeddings().aembed_queries_array(variants)
+            doc_lists = await vector_store.asearch_docs_batch(user_id, query_embeddings, expr, top_k, partition_keys,
+                                                              collection=collection)
+            query_docs = reciprocal_rank_fusion(doc_lists, top_n=top_k)
+            # 不同变体的距离不在同一个尺度上，不能放在一起归一化，
+            # 融合后的归一化分数用RRF分数除以可能的最大值（每个变体都排第一）
+            max_rrf_score = len(doc_lists) / (RRF_K + 1)
+            norm_scores = [doc.metadata['rrf_score'] / max_rrf_score for doc in query_docs]
+            debug_logger.info(f"multi-query search with {len(variants)} variants, "
+                              f"hits: {[len(docs) for docs in doc_lists]}, fused: {len(query_docs)}")
+        elif user_id:
+            # 查询向量异步计算一次（按查询文本缓存），之后在milvus客户端的线程池中检索用户自己的集合，不阻塞事件循环
+            query_embedding = await get_embeddings().aembed_query(query)
+            query_docs = await vector_store.asearch_docs(user_id, query, expr, top_k, partition_keys,
+                                                         query_embedding=query_embedding, collection=collection)
+        else:
+            # 没有user_id时检索当前集合，同样放到线程池中执行
+            loop = asyncio.get_running_loop()
+            query_docs = await loop.run_in_executor(vector_store.executor, vector_store.search_docs,
+                                                    query, expr, top_k, partition_keys)
+        if norm_scores is None:
+            # 单个查询的L2距离越小越相关，归一化后用于融合
+            norm_scores = normalize_scores([doc.metadata['distance'] for doc in query_docs], lower_is_better=True)
+        for doc, norm_score in zip(query_docs, norm_scores):
             doc.metadata['retrieval_source'] = 'milvus'
-        milvus_end_time = time.perf_counter()
-        time_record['retriever_search_by_milvus'] = round(milvus_end_time - milvus_start_time, 2)
+            doc.metadata['norm_score'] = norm_score
+        return query_docs
+
+    async def search_es(self, query: str, es_store: ElasticsearchStore, partition_keys: List[str], top_k: int,
+                        exclude_file_ids: List[str] = None) -> List[Document]:
+        if es_store is None:
+            raise ValueError("es is not available")
+        filter = [{"terms": {"metadata.kb_id.keyword": partition_keys}}]
+        if exclude_file_ids:
+            filter.append({"bool": {"must_not": [{"terms": {"metadata.file_id.keyword": exclude_file_ids}}]}})
+        docs_with_scores = await es_store.asimilarity_search_with_score(query, k=top_k, filter=filter)
+        es_sub_docs = [doc for doc, _ in docs_with_scores]
+        norm_scores = normalize_scores([score for _, score in docs_with_scores])
+        for (doc, score), norm_score in zip(docs_with_scores, norm_scores):
+            doc.metadata['retrieval_source'] = 'es'
+            doc.metadata['bm25_score'] = score
+            doc.metadata['norm_score'] = norm_score
+        return es_sub_docs
+
+    @staticmethod
+    async def _timed(coro, timeout: float):
+        """执行一个检索分支，返回 (结果, 耗时, 异常)，超时按异常处理，timeout为None时不限时"""
+        start_time = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(coro, timeout)
+            return result, time.perf_counter() - start_time, None
+        except Exception as e:
+            return None, time.perf_counter() - start_time, e
+
+    async def get_retrieved_documents(self, query: str, vector_store: MilvusClient, es_store: ElasticsearchStore, partition_keys: List[str], time_record: dict,
+                                    hybrid_search: bool, top_k: int, expr: str = None, user_id: str = None,
+                                    query_variants: List[str] = None, exclude_file_ids: List[str] = None):
+        # 已删除的文件直接在milvus的expr和es的filter中排除
+        if exclude_file_ids:
+            exclude_expr = f"file_id not in {json.dumps(list(exclude_file_ids))}"
+            expr = f"({expr}) and {exclude_expr}" if expr else exclude_expr
+
+        async def milvus_search(timeout):
+            collection = None
+            if user_id:
+                # 用户第一次检索时要创建或加载集合，可能远远超过检索的超时时间，所以获取集合不计入超时
+                load_start_time = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                collection = await loop.run_in_executor(vector_store.executor, vector_store.get_collection, user_id)
+                time_record['retriever_get_collection'] = round(time.perf_counter() - load_start_time, 2)
+            return await asyncio.wait_for(self.search_milvus(query, vector_store, partition_keys, top_k, expr, user_id,
+                                                             query_variants, collection=collection), timeout)
 
         if not hybrid_search:
+            # 只有milvus一路时不设超时，和原来一样等检索完成
+            start_time = time.perf_counter()
+            query_docs = await milvus_search(None)
+            time_record['retriever_search_by_milvus'] = round(time.perf_counter() - start_time, 2)
             return query_docs
-        try:
-            filter = [{"terms": {"metadata.kb_id.keyword": partition_keys}}]
-            es_sub_docs = await es_store.asimilarity_search(query, k=top_k, filter=filter)
-            print(es_sub_docs)
-            for doc in es_sub_docs:
-                doc.metadata['retrieval_source'] = 'es'
-            time_record['retriever_search_by_es'] = round(time.perf_counter() - milvus_end_time, 2)
+
+        # 混合检索：milvus和es同时检索，总耗时约为两者中较慢的一个，而不是两者之和
+        # milvus分支的超时只限制检索本身，es不用等milvus加载集合
+        start_time = time.perf_counter()
+        (query_docs, milvus_time, milvus_error), (es_sub_docs, es_time, es_error) = await asyncio.gather(
+            self._timed(milvus_search(self.milvus_timeout), None),
+            self._timed(self.search_es(query, es_store, partition_keys, top_k, exclude_file_ids), self.es_timeout))
+        total_time = time.perf_counter() - start_time
+        time_record['retriever_search_by_milvus'] = round(milvus_time, 2)
+        time_record['retriever_search_by_es'] = round(es_time, 2)
+        # 并发节省的时间：两个分支耗时之和减去实际总耗时
+        time_record['retriever_search_overlap'] = round(max(milvus_time + es_time - total_time, 0.0), 2)
+
+        if milvus_error is not None:
+            debug_logger.error(f"Error in get_retrieved_documents on milvus_search: {milvus_error!r}")
+        if es_error is not None:
+            debug_logger.error(f"Error in get_retrieved_documents on es_search: {es_error!r}")
+        if milvus_error is not None and es_error is not None:
+            # 两个分支都失败时，和原来一样抛出milvus的异常
+            raise milvus_error
+        # 只有一个分支成功时返回部分结果
+        query_docs = query_docs or []
+        es_sub_docs = es_sub_docs or []
+        if not self.fusion_method:
             debug_logger.info(f"Got {len(query_docs)} documents from vectorstore and {len(es_sub_docs)} documents from es, total {len(query_docs) + len(es_sub_docs)} merged documents.")
-            query_docs.extend(es_sub_docs)
-        except Exception as e:
-            debug_logger.error(f"Error in get_retrieved_documents on es_search: {e}")
-        return query_docs
\ No newline at end of file
+            return query_docs + es_sub_docs
+        # 两路结果按文档块去重后加权融合，融合分数记在 metadata['score']，只保留top_k个
+        fused_docs = weighted_fusion([query_docs, es_sub_docs], [self.milvus_weight, self.es_weight],
+                                     method=self.fusion_method, top_n=top_k)
+        debug_logger.info(f"Got {len(query_docs)} documents from vectorstore and {len(es_sub_docs)} documents from es, "
+                          f"{self.fusion_method} fused {len(fused_docs)} documents.")
+        return fused_docs
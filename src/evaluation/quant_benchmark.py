@@ -0,0 +1,161 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+usage_guide = '''
+对比fp32和int8量化模型的推理速度和精度，量化模型需要先运行 src/server/quantize_onnx.py 生成
+
+参数说明
+- `--model`: 测试的模型，embedding / rerank / all (默认: all)
+- `--max_samples`: RAGTruth中最多使用的QA样本数 (默认: 200)
+- `--use_gpu`: 使用GPU推理，量化模型主要面向CPU部署，默认在CPU上测试
+- `--output`: 结果保存路径 (默认: ./quant_benchmark_results.json)
+
+数据集
+- RAGTruth: model_response 中 QA 任务的 question 和 passages，用于检索和rerank排序的一致性
+- BasicEval: file 目录下的 txt 文档按段落切分，用于向量相似度和延迟
+
+精度指标
+- embedding: int8与fp32向量的余弦相似度，以及按向量检索时 top1 命中的一致率
+- rerank: 分数的平均绝对误差，top1 一致率和排序的 Spearman 相关系数
+'''
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+current_dir_path = os.path.dirname(current_script_path)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))
+sys.path.append(root_dir)
+
+from src.server.embedding_server.embedding_backend import EmbeddingBackend
+from src.server.rerank_server.rerank_backend import RerankBackend
+
+
+def load_ragtruth_qa(max_samples: int) -> List[Tuple[str, List[str]]]:
+    """读取RAGTruth的QA样本，返回 [(question, passages)]，不同模型的response文件中样本重复，按question去重"""
+    samples = {}
+    for path in sorted(glob.glob(os.path.join(current_dir_path, "RAGTruth", "model_response", "*.jsonl"))):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                data = json.loads(line)
+                if data['task_type'] != 'QA' or not isinstance(data['source_info'], dict):
+                    continue
+                question = data['source_info']['question']
+                # passages 的格式为 "passage 1:...\n\npassage 2:..."
+                passages = [p.strip() for p in re.split(r'passage \d+:', data['source_info']['passages']) if p.strip()]
+                if len(passages) > 1:
+                    samples.setdefault(question, passages)
+                if len(samples) >= max_samples:
+                    return list(samples.items())
+    return list(samples.items())
+
+
+def load_basic_eval_chunks(min_chars: int = 50) -> List[str]:
+    """读取BasicEval的txt文档，按空行切分为段落"""
+    chunks = []
+    for path in sorted(glob.glob(os.path.join(current_dir_path, "BasicEval", "file", "*.txt"))):
+        with open(path, "r", encoding="utf-8") as f:
+            chunks.extend(p.strip() for p in f.read().split("\n\n") if len(p.strip()) >= min_chars)
+    return chunks
+
+
+def spearman(a, b) -> float:
+    if len(a) < 2:
+        return 1.0
+    rank_a = np.argsort(np.argsort(a))
+    rank_b = np.argsort(np.argsort(b))
+    if rank_a.std() == 0 or rank_b.std() == 0:
+        return 1.0
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+def timed(func, *args):
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start_time
+
+
+def bench_embedding(qa_samples, chunks, use_gpu: bool) -> dict:
+    backends = {variant: EmbeddingBackend(use_cpu=not use_gpu, model_variant=variant) for variant in ('fp32', 'int8')}
+    results = {}
+    # BasicEval：向量相似度和延迟
+    texts = chunks
+    vectors, latency = {}, {}
+    for variant, backend in backends.items():
+        # 预热一次，排除首次推理的初始化开销
+        backend.predict(texts[:8], return_numpy=True)
+        vectors[variant], latency[variant] = timed(lambda t: backend.predict(t, return_numpy=True), texts)
+    cosine = np.sum(vectors['fp32'] * vectors['int8'], axis=1) / (
+        np.linalg.norm(vectors['fp32'], axis=1) * np.linalg.norm(vectors['int8'], axis=1))
+    results['BasicEval'] = {'texts': len(texts),
+                            'fp32_time': round(latency['fp32'], 4), 'int8_time': round(latency['int8'], 4),
+                            'speedup': round(latency['fp32'] / latency['int8'], 3),
+                            'cosine_mean': round(float(cosine.mean()), 6),
+                            'cosine_min': round(float(cosine.min()), 6)}
+    # RAGTruth：question检索passages的top1是否一致
+    agree, latency = 0, {'fp32': 0.0, 'int8': 0.0}
+    for question, passages in qa_samples:
+        top1 = {}
+        for variant, backend in backends.items():
+            embs, cost = timed(lambda t: backend.predict(t, return_numpy=True), [question] + passages)
+            latency[variant] += cost
+            top1[variant] = int(np.argmax(embs[1:] @ embs[0]))
+        agree += top1['fp32'] == top1['int8']
+    results['RAGTruth'] = {'samples': len(qa_samples),
+                           'fp32_time': round(latency['fp32'], 4), 'int8_time': round(latency['int8'], 4),
+                           'speedup': round(latency['fp32'] / max(latency['int8'], 1e-9), 3),
+                           'top1_agreement': round(agree / max(len(qa_samples), 1), 4)}
+    return results
+
+
+def bench_rerank(qa_samples, use_gpu: bool) -> dict:
+    # 关闭分数缓存，否则预热和重复的 (query, passage) 直接命中缓存，测到的不是推理延迟
+    backends = {variant: RerankBackend(use_cpu=not use_gpu, model_variant=variant, score_cache_size=0)
+                for variant in ('fp32', 'int8')}
+    for backend in backends.values():
+        backend.get_rerank(*qa_samples[0])
+    latency = {'fp32': 0.0, 'int8': 0.0}
+    abs_errors, correlations, agree = [], [], 0
+    for question, passages in qa_samples:
+        scores = {}
+        for variant, backend in backends.items():
+            scores[variant], cost = timed(backend.get_rerank, question, passages)
+            scores[variant] = np.asarray(scores[variant], dtype=np.float32)
+            latency[variant] += cost
+        abs_errors.append(np.abs(scores['fp32'] - scores['int8']).mean())
+        correlations.append(spearman(scores['fp32'], scores['int8']))
+        agree += int(np.argmax(scores['fp32'])) == int(np.argmax(scores['int8']))
+    return {'RAGTruth': {'samples': len(qa_samples),
+                         'fp32_time': round(latency['fp32'], 4), 'int8_time': round(latency['int8'], 4),
+                         'speedup': round(latency['fp32'] / max(latency['int8'], 1e-9), 3),
+                         'score_mae': round(float(np.mean(abs_errors)), 6),
+                         'spearman_mean': round(float(np.mean(correlations)), 4),
+                         'top1_agreement': round(agree / len(qa_samples), 4)}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=usage_guide, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', type=str, default='all', choices=['embedding', 'rerank', 'all'])
+    parser.add_argument('--max_samples', type=int, default=200)
+    parser.add_argument('--use_gpu', action="store_true", help='use gpu or not')
+    parser.add_argument('--output', type=str, default='./quant_benchmark_results.json')
+    args = parser.parse_args()
+
+    qa_samples = load_ragtruth_qa(args.max_samples)
+    chunks = load_basic_eval_chunks()
+    print(f"RAGTruth QA samples: {len(qa_samples)}, BasicEval chunks: {len(chunks)}")
+    report = {}
+    if args.model in ('embedding', 'all'):
+        report['embedding'] = bench_embedding(qa_samples, chunks, args.use_gpu)
+    if args.model in ('rerank', 'all'):
+        report['rerank'] = bench_rerank(qa_samples, args.use_gpu)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
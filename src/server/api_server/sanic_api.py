@@ -14,6 +14,7 @@ root_dir = os.path.dirname(root_dir)
 sys.path.append(root_dir)
 from sanic_api_handler import *
 from src.core.qa_handler import QAHandler
+from src.client.http_pool import get_model_service_pool
 from src.utils.log_handler import debug_logger, qa_logger
 from src.utils.general_utils import my_print
 from sanic.worker.manager import WorkerManager
@@ -52,6 +53,13 @@ async def init_qa_handler(app, loop):
     print(f'init local_doc_qa cost {(end - start):.4f} seconds', flush=True)
     app.ctx.qa_handler = qa_handler
     
+@app.after_server_stop
+async def close_model_service_pool(app, loop):
+    # 关闭访问模型服务的长连接
+    await get_model_service_pool().close()
+    # 关闭mysql异步连接池
+    await app.ctx.qa_handler.async_mysql_client.close()
+
 @app.after_server_start
 async def notify_server_started(app, loop):
     print(f"Server Start Cost {(time.time() - start_time):.4f} seconds", flush=True)
@@ -5,7 +5,6 @@ import sys
 import os
 
 import time
-import traceback
 import urllib
 # 获取当前脚本的绝对路径
 current_script_path = os.path.abspath(__file__)
@@ -24,9 +23,10 @@ from src.utils.general_utils import get_time, get_time_async, \
     safe_get, check_user_id_and_user_info, correct_kb_id, \
         check_filename
 from src.core.qa_handler import QAHandler
+from src.client.http_pool import get_model_service_pool
 from src.utils.log_handler import debug_logger
 from src.utils.general_utils import  fast_estimate_file_char_count
-from src.core.file_handler.file_handler import LocalFile, FileHandler
+from src.core.file_handler.file_handler import LocalFile
 from sanic import request
 from sanic.response import text as sanic_text
 from sanic.response import json as sanic_json
@@ -94,7 +94,11 @@ async def document(req: request):
 @get_time_async
 async def health_check(req: request):
     # 实现一个服务健康检查的逻辑，正常就返回200，不正常就返回500
-    return sanic_json({"code": 200, "msg": "success"})
+    # 附带访问embedding、rerank服务的连接池统计
+    # 附带mysql异步连接池的等待时间和查询耗时统计
+    qa_handler: QAHandler = req.app.ctx.qa_handler
+    return sanic_json({"code": 200, "msg": "success", "model_service_pool": get_model_service_pool().stats(),
+                       "mysql": qa_handler.async_mysql_client.stats()})
 
 @get_time_async
 async def new_knowledge_base(req: request):
@@ -120,12 +124,14 @@ async def new_knowledge_base(req: request):
     if kb_id[:2] != 'KB':
         return sanic_json({"code": 2001, "msg": "fail, kb_id must start with 'KB'"})
     # 判断kb_id是否存在，不存在则返回kb_id，存在则返回空
-    not_exist_kb_ids = qa_handler.mysql_client.check_kb_exist(user_id, [kb_id])
+    not_exist_kb_ids = await qa_handler.async_mysql_client.check_kb_exist(user_id, [kb_id])
     if not not_exist_kb_ids:
         return sanic_json({"code": 2001, "msg": "fail, knowledge Base {} already exist".format(kb_id)})
 
     # local_doc_qa.create_milvus_collection(user_id, kb_id, kb_name)
-    qa_handler.mysql_client.new_milvus_base(kb_id, user_id, kb_name)
+    await qa_handler.async_mysql_client.new_milvus_base(kb_id, user_id, kb_name)
+    # 知识库变化后丢弃milvus集合和分区的缓存
+    qa_handler.milvus_client.invalidate_collection(user_id)
     now = datetime.now()
     timestamp = now.strftime("%Y%m%d%H%M")
     return sanic_json({"code": 200, "msg": "success create knowledge base {}".format(kb_id),
@@ -152,12 +158,12 @@ async def upload_files(req: request):
     debug_logger.info("chunk_size: %s", chunk_size)
     files = req.files.getlist('files')
     debug_logger.info(f"{user_id} upload files number: {len(files)}")
-    not_exist_kb_ids = qa_handler.mysql_client.check_kb_exist(user_id, [kb_id])
+    not_exist_kb_ids = await qa_handler.async_mysql_client.check_kb_exist(user_id, [kb_id])
     if not_exist_kb_ids:
         msg = "invalid kb_id: {}, please check...".format(not_exist_kb_ids)
         return sanic_json({"code": 2001, "msg": msg, "data": [{}]})
     
-    exist_files = qa_handler.mysql_client.get_files(user_id, kb_id)
+    exist_files = await qa_handler.async_mysql_client.get_files(user_id, kb_id)
     if len(exist_files) + len(files) > 10000:
         return sanic_json({"code": 2002,
                            "msg": f"fail, exist files is {len(exist_files)}, upload files is {len(files)}, total files is {len(exist_files) + len(files)}, max length is 10000."})
@@ -185,7 +191,7 @@ async def upload_files(req: request):
 
     exist_file_names = []
     if mode == 'soft':
-        exist_files = qa_handler.mysql_client.check_file_exist_by_name(user_id, kb_id, file_names)
+        exist_files = await qa_handler.async_mysql_client.check_file_exist_by_name(user_id, kb_id, file_names)
         exist_file_names = [f[1] for f in exist_files]
         for exist_file in exist_files:
             file_id, file_name, file_size, status = exist_file
@@ -215,54 +221,14 @@ async def upload_files(req: request):
         file_size = len(local_file.file_content)
         file_location = local_file.file_location
         # local_files.append(local_file)
-        # 加到mysql数据库中
-        msg = qa_handler.mysql_client.add_file(file_id, user_id, kb_id, file_name, file_size, file_location,
-                                                   chunk_size, timestamp)
+        # 加到mysql数据库中，状态为gray（等待入库），由后台入库worker领取后解析、向量化
+        msg = await qa_handler.async_mysql_client.add_file(file_id, user_id, kb_id, file_name, file_size,
+                                                         file_location, chunk_size, timestamp, status="gray")
         debug_logger.info(f"{file_name}, {file_id}, {msg}")
-        # 将文件切割向量化并保存到向量数据库中
-        kb_name = qa_handler.mysql_client.get_knowledge_base_name([local_file.kb_id])[0][2]
-        file_handler = FileHandler(local_file.user_id, kb_name, local_file.kb_id, 
-                                         local_file.file_id, local_file.file_location, 
-                                         local_file.file_name, chunk_size)
-        # txt
-        # 将文件转换为Document类型，langchain
-        file_handler.split_file_to_docs() # Document类
-        # print(file_handler.docs)
-        # 将处理好的Document中内容进行切分 切父块800 没重叠  切子块400 重叠部分100
-        file_handler.docs, full_docs = FileHandler.split_docs(file_handler.docs)
-        parent_chunk_number = len(set(doc.metadata["doc_id"] for doc in file_handler.docs)) # file_handler.docs 列表中每个元素 doc 的不重复的 doc.doc_id 数量
-        # 将切分好的Document存入向量数据库中
-        qa_handler.milvus_client.load_collection_(user_id)
-        for doc in file_handler.docs:
-            # 这里应该能用列表直接把所有的给向量化
-            textvec = qa_handler.embeddings.embed_query(doc.page_content)
-            # print(textvec)
-            file_handler.embs.append(textvec)
-            qa_handler.milvus_client.store_doc(doc, textvec)
-        # 打印切好的子块
-        # print(file_handler.docs)
-        # 将切分好的子块存入es数据库中
-        if qa_handler.es_client is not None:
-            try:
-                # docs的doc_id是file_id + '_' + i 注意这里的docs_id指的是es数据库中的唯一标识
-                # 而不是父块编号
-                docs_ids = [doc.metadata['file_id'] + '_' + str(i) for i, doc in enumerate(file_handler.docs)]
-                # ids指定文档的唯一标识符
-                es_res = await qa_handler.es_client.es_store.aadd_documents(file_handler.docs, ids=docs_ids)
-                debug_logger.info(f'es_store insert number: {len(es_res)}, {es_res[0]}')
-            except Exception as e:
-                debug_logger.error(f"Error in aadd_documents on es_store: {traceback.format_exc()}")
-        # 存入完以后更新mysql中file表的chunks_number
-        # 将切好的父doc存入mysql数据库中
-        qa_handler.mysql_client.store_parent_chunks(full_docs)
-        # 更新文件的chunk number
-        qa_handler.mysql_client.modify_file_chunks_number(file_id, user_id, kb_id, parent_chunk_number)
         # 返回给前端的数据
-        data.append({"file_id": file_id, "file_name": file_name, "status": "green", 
+        data.append({"file_id": file_id, "file_name": file_name, "status": "gray", 
                      "bytes": len(local_file.file_content), "timestamp": timestamp, "estimated_chars": chars})
-    # qanything 1.x版本处理方式，2.0以后的版本都是起另外一个服务轮询文件状态，之后添加到向量数据库中
-    # 后面做优化在像他们那样做，这样文件上传流程会快不少
-    # asyncio.create_task(local_doc_qa.insert_files_to_l(user_id, kb_id, local_files))
+    # 和qanything 2.0以后的版本一样，文件的解析、向量化由 src/server/ingest_server/ingest_worker.py 轮询文件状态后完成
     if failed_files:
         msg = f"warning, {failed_files} chars is too much, max characters length is {MAX_CHARS}, skip upload."
     elif record_exist_files:
@@ -367,9 +333,9 @@ async def local_doc_chat(req: request):
     debug_logger.info("hybrid_search: %s", hybrid_search)
     debug_logger.info("chunk_size: %s", chunk_size)
 
-    qa_handler.milvus_client.load_collection_(user_id)
+    # 不再在这里加载集合，检索时按user_id在milvus客户端的线程池中获取集合
     if kb_ids:
-        not_exist_kb_ids = qa_handler.mysql_client.check_kb_exist(user_id, kb_ids)
+        not_exist_kb_ids = await qa_handler.async_mysql_client.check_kb_exist(user_id, kb_ids)
         if not_exist_kb_ids:
             return sanic_json({"code": 2003, "msg": "fail, knowledge Base {} not found".format(not_exist_kb_ids)})
     
@@ -377,7 +343,7 @@ async def local_doc_chat(req: request):
     
     file_infos = []
     for kb_id in kb_ids:
-        file_infos.extend(qa_handler.mysql_client.get_files(user_id, kb_id))
+        file_infos.extend(await qa_handler.async_mysql_client.get_files(user_id, kb_id))
         
     # print("DEBUG: ", file_infos)
     valid_files = [fi for fi in file_infos if fi[2] == 'green']
@@ -402,6 +368,7 @@ async def local_doc_chat(req: request):
                                                                                     kb_ids=kb_ids,
                                                                                     query=question,
                                                                                     retriever=qa_handler.retriever,
+                                                                                    user_id=user_id,
                                                                                     chat_history=history,
                                                                                     streaming=True,
                                                                                     rerank=rerank,
@@ -437,7 +404,7 @@ async def local_doc_chat(req: request):
                                     'condense_question': resp['condense_question'], 'prompt': resp['prompt'],
                                     'result': result, 'retrieval_documents': retrieval_documents,
                                     'source_documents': source_documents}
-                        qa_handler.mysql_client.add_qalog(**chat_data)
+                        await qa_handler.async_mysql_client.add_qalog(**chat_data)
                         debug_logger.info("chat_data: %s", chat_data)
                         debug_logger.info("response: %s", chat_data['result'])
                         stream_res = {
@@ -483,6 +450,7 @@ async def local_doc_chat(req: request):
                                                                            kb_ids=kb_ids,
                                                                            query=question,
                                                                            retriever=qa_handler.retriever,
+                                                                           user_id=user_id,
                                                                            chat_history=history, streaming=False,
                                                                            rerank=rerank,
                                                                            custom_prompt=custom_prompt,
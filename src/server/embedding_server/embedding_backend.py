@@ -5,43 +5,55 @@ from typing import List, Union
 from numpy import ndarray
 import torch
 from torch import Tensor
-from onnxruntime import InferenceSession, SessionOptions, GraphOptimizationLevel
 from src.configs.configs import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_BATCH, LOCAL_RERANK_MAX_LENGTH, EMBED_MODEL_PATH
 from src.utils.log_handler import debug_logger
+from src.utils.cache_utils import TokenCache
+from src.utils.session_pool import SessionPool
+from src.server.embedding_server.embedding_cache import EmbeddingCache
+from src.server.quantize_onnx import get_model_path
 from transformers import AutoTokenizer
 
 
 class EmbeddingBackend:
-    def __init__(self, use_cpu: bool = False):
+    def __init__(self, use_cpu: bool = False, cache_path: str = None, cache_memory_size: int = 20000,
+                 cache_max_rows: int = 1000000,
+                 model_variant: str = 'fp32', num_sessions: int = None, intra_op_threads: int = None,
+                 pin_cores: bool = False, core_offset: int = 0):
         # 初始化分词器
         self._tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_PATH)
+        # 分词结果缓存，相同文本（重复的chunk、query）不再重复分词
+        self._token_cache = TokenCache(self._tokenizer)
         # 设置返回numpy数组形式
         self.return_tensors = "np"
         # 批处理大小
         self.batch_size = LOCAL_EMBED_BATCH
         # 最大文本长度
         self.max_length = LOCAL_RERANK_MAX_LENGTH
-        # 进行onnx会话配置
-        sess_options = SessionOptions()
-        sess_options.intra_op_num_threads = 0
-        sess_options.inter_op_num_threads = 0
-        sess_options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 模型版本，int8为quantize_onnx.py生成的动态量化模型，适合纯CPU部署
+        self.model_path = get_model_path(LOCAL_EMBED_MODEL_PATH, model_variant)
         if use_cpu:
             providers = ['CPUExecutionProvider']
         else:
             # CUDA优先，如果GPU不可用会自动降级到CPU
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        # 这行代码创建了一个ONNX模型的推理会话，是ONNX Runtime的核心组件。
+        # 创建ONNX模型的推理会话池，会话数和每个会话的线程数为空时按可用核数自动配置
         # 路径.onnx为后缀的文件，这是转换自其他深度学习框架（如PyTorch、TensorFlow、Transformer）的模型
-        self._session = InferenceSession(
-            LOCAL_EMBED_MODEL_PATH, sess_options=sess_options, providers=providers)
+        self._session_pool = SessionPool(self.model_path, providers, num_sessions=num_sessions,
+                                         intra_op_threads=intra_op_threads, pin_cores=pin_cores,
+                                         core_offset=core_offset,
+                                         name='embedding')
 
         # 动态获取输出名称，支持不同的模型格式
-        self._output_names = [o.name for o in self._session.get_outputs()]
+        self._output_names = [o.name for o in self._session_pool.get_outputs()]
         debug_logger.info(
-            f"EmbeddingClient: model_path: {LOCAL_EMBED_MODEL_PATH}")
+            f"EmbeddingClient: model_path: {self.model_path}")
         debug_logger.info(
             f"EmbeddingClient: output_names: {self._output_names}")
+        # 持久化向量缓存，cache_path为空时不启用
+        self._embedding_cache = None
+        if cache_path:
+            self._embedding_cache = EmbeddingCache(cache_path, self.model_path, self.max_length,
+                                                   memory_size=cache_memory_size, max_rows=cache_max_rows)
     # 获取文本嵌入向量
 
     def get_embedding(self, sentences, max_length):
@@ -55,8 +67,7 @@ class EmbeddingBackend:
         # 记录开始时间
         start_time = time.time()
         # 模型推理
-        outputs_onnx = self._session.run(
-            output_names=self._output_names, input_feed=inputs_onnx)
+        outputs_onnx = self._session_pool.run(self._output_names, inputs_onnx)
         debug_logger.info(f"onnx infer time: {time.time() - start_time}")
         # outputs_onnx[0]: 获取第一个（也是唯一的）输出
         #  [:,0]使用numpy切片，选择所有样本的[CLS]标记对应的向量
@@ -85,23 +96,25 @@ class EmbeddingBackend:
         try_num = 2
         while outputs_onnx is None and try_num > 0:
             try:
-                io_binding = self._session.io_binding()
-                # 绑定输入
-                for k, v in inputs.items():
-                    # 将输入数据绑定到CPU内存
-                    io_binding.bind_cpu_input(k, v)
-                # 确保输入数据同步
-                io_binding.synchronize_inputs()
-                # 绑定输出
-                io_binding.bind_output(self._output_names[0])
-                # 使用IO binding执行推理
-                self._session.run_with_iobinding(io_binding)
-                # 确保输出数据同步
-                io_binding.synchronize_outputs()
-                # 确保输出数据同步
-                outputs_onnx = io_binding.copy_outputs_to_cpu()
-                io_binding.clear_binding_inputs()
-                io_binding.clear_binding_outputs()
+                # 从会话池借出一个空闲会话，多个推理线程不再共用同一个会话
+                with self._session_pool.acquire() as session:
+                    io_binding = session.io_binding()
+                    # 绑定输入
+                    for k, v in inputs.items():
+                        # 将输入数据绑定到CPU内存
+                        io_binding.bind_cpu_input(k, v)
+                    # 确保输入数据同步
+                    io_binding.synchronize_inputs()
+                    # 绑定输出
+                    io_binding.bind_output(self._output_names[0])
+                    # 使用IO binding执行推理
+                    session.run_with_iobinding(io_binding)
+                    # 确保输出数据同步
+                    io_binding.synchronize_outputs()
+                    # 确保输出数据同步
+                    outputs_onnx = io_binding.copy_outputs_to_cpu()
+                    io_binding.clear_binding_inputs()
+                    io_binding.clear_binding_outputs()
             except Exception as e:
                 debug_logger.error(f"ONNX 推理异常 (尝试 {3-try_num}/2): {str(e)}")
                 debug_logger.error(f"异常详情: {traceback.format_exc()}")
@@ -110,6 +123,21 @@ class EmbeddingBackend:
         # 返回结果
         return outputs_onnx
 
+    def _build_inputs(self, token_ids_list: List[List[int]], max_length: int):
+        """用缓存中不带特殊token的input_ids构造模型输入，截断到max_length并补上特殊token"""
+        num_special = self._tokenizer.num_special_tokens_to_add(pair=False)
+        with_token_type = 'token_type_ids' in self._tokenizer.model_input_names
+        encoded = {'input_ids': [], 'attention_mask': []}
+        if with_token_type:
+            encoded['token_type_ids'] = []
+        for token_ids in token_ids_list:
+            input_ids = self._tokenizer.build_inputs_with_special_tokens(token_ids[:max_length - num_special])
+            encoded['input_ids'].append(input_ids)
+            encoded['attention_mask'].append([1] * len(input_ids))
+            if with_token_type:
+                encoded['token_type_ids'].append([0] * len(input_ids))
+        return encoded
+
     def encode(self, sentence: Union[str, List[str]],
                return_numpy: bool = False,
                normalize_to_unit: bool = True,
@@ -130,32 +158,36 @@ class EmbeddingBackend:
         tokens_num = 0
         using_time_tokenizer = 0
         using_time_model = 0
-        # batch数，向上取整
-        total_batch = len(sentence) // batch_size + \
-            (1 if len(sentence) % batch_size > 0 else 0)
+        # 如果没指定标记化的tokenizer就用默认的
+        if tokenizer is None:
+            tokenizer = self._tokenizer
+        # 先对全部句子做一次不padding的分词，按token长度排序后再切batch，
+        # 长度相近的句子分到同一个batch里，避免一条长句把整个batch都padding到最长
+        start_time_tokenizer = time.time()
+        if tokenizer is self._tokenizer:
+            # 默认分词器走分词缓存
+            encoded = self._build_inputs(self._token_cache.encode_batch(sentence), max_length)
+        else:
+            encoded = tokenizer(
+                sentence,
+                padding=False,
+                truncation=True,
+                max_length=max_length
+            )
+        using_time_tokenizer += (time.time() - start_time_tokenizer)
+        lengths = [len(input_ids) for input_ids in encoded['input_ids']]
+        # 稳定排序，记录排序后的位置，最后用来还原原始顺序
+        sorted_idx = np.argsort(lengths, kind='stable')
         # 开始处理batch
-        for batch_id in range(total_batch):
+        for batch_start in range(0, len(sentence), batch_size):
+            batch_idx = sorted_idx[batch_start:batch_start + batch_size]
             start_time_tokenizer = time.time()
-            # 如果指定了标记化的tokenizer
-            if tokenizer is not None:
-                inputs = tokenizer(
-                    sentence[batch_id *
-                             batch_size:(batch_id + 1) * batch_size],
-                    padding=True,
-                    truncation=True,
-                    max_length=max_length,
-                    return_tensors="np"
-                )
-            else:
-                # 如果没指定就用默认的
-                inputs = self._tokenizer(
-                    sentence[batch_id *
-                             batch_size:(batch_id + 1) * batch_size],
-                    padding=True,
-                    truncation=True,
-                    max_length=max_length,
-                    return_tensors="np"
-                )
+            # 只padding到当前batch内的最长句子
+            inputs = tokenizer.pad(
+                {k: [v[i] for i in batch_idx] for k, v in encoded.items()},
+                padding=True,
+                return_tensors="np"
+            )
             using_time_tokenizer += (time.time() - start_time_tokenizer)
             # 这行代码计算实际的token数量，减去了特殊token（如[CLS]和[SEP]）的数
             if return_tokens_num:
@@ -195,6 +227,10 @@ class EmbeddingBackend:
         # #  [7,  8,  9],
         # #  [10, 11, 12]]
         embeddings = np.concatenate(embedding_list, axis=0)
+        # 按长度排序后推理的结果，还原回输入顺序
+        restored = np.empty_like(embeddings)
+        restored[sorted_idx] = embeddings
+        embeddings = restored
         # 当输入是单个句子且不需要保持维度时
         # 去掉第一个维度，从2D变为1D
         # 例如：从形状(1, 768)变为(768,)
@@ -218,12 +254,34 @@ class EmbeddingBackend:
             return embeddings
     # 对给定queries
 
-    def predict(self, queries, return_tokens_num=False):
-        print(queries)
-        embeddings = self.encode(
-            queries, batch_size=self.batch_size, normalize_to_unit=True, return_numpy=True, max_length=self.max_length,
-            tokenizer=self._tokenizer,
-            return_tokens_num=return_tokens_num
-        )
-        print(embeddings.shape)
-        return embeddings.tolist()
+    def session_stats(self):
+        return self._session_pool.stats()
+
+    def cache_stats(self):
+        return self._embedding_cache.stats() if self._embedding_cache is not None else None
+
+    def predict(self, queries, return_tokens_num=False, return_numpy=False):
+        debug_logger.info(f"predict texts number: {len(queries)}")
+        if self._embedding_cache is None or return_tokens_num:
+            embeddings = self.encode(
+                queries, batch_size=self.batch_size, normalize_to_unit=True, return_numpy=True, max_length=self.max_length,
+                tokenizer=self._tokenizer,
+                return_tokens_num=return_tokens_num
+            )
+            debug_logger.info(f"predict embeddings shape: {embeddings.shape}")
+            return embeddings if return_numpy else embeddings.tolist()
+        # 先查向量缓存，只对未命中的文本做推理
+        cached = self._embedding_cache.get_many(queries)
+        miss_idx = [i for i, vector in enumerate(cached) if vector is None]
+        if miss_idx:
+            miss_queries = [queries[i] for i in miss_idx]
+            embeddings = self.encode(
+                miss_queries, batch_size=self.batch_size, normalize_to_unit=True, return_numpy=True,
+                max_length=self.max_length, tokenizer=self._tokenizer
+            )
+            self._embedding_cache.put_many(miss_queries, embeddings)
+            for i, vector in zip(miss_idx, embeddings):
+                cached[i] = vector
+        debug_logger.info(f"predict embedding cache hits: {len(queries) - len(miss_idx)}/{len(queries)}")
+        embeddings = np.stack(cached)
+        return embeddings if return_numpy else embeddings.tolist()
@@ -0,0 +1,143 @@
+import asyncio
+import time
+import traceback
+from typing import List
+
+import numpy as np
+
+from src.utils.inference_executor import InferenceExecutor, InferenceQueueFull
+from src.utils.log_handler import debug_logger, embed_logger
+
+
+class EmbeddingBatcher:
+    """
+    动态微批调度器
+
+    在 max_wait_ms 的时间窗口内收集多个并发请求的文本，凑满 max_batch_size 或者超时后
+    合并成一次推理，推理交给 InferenceExecutor 在线程池中执行（不阻塞事件循环），
+    最后按请求把结果拆分返回。线程池有空闲时才开始凑下一批，推理繁忙时排队的请求
+    会自然合并成更大的batch。
+    max_queue 是允许在调度器中排队等待凑批的请求数，超过时直接抛出 InferenceQueueFull。
+    同时统计请求在调度器中的等待时间和到开始推理的总排队时间。
+    """
+
+    def __init__(self, backend, max_batch_size: int, max_wait_ms: float = 5,
+                 executor: InferenceExecutor = None, max_queue: int = None):
+        self.backend = backend
+        # 单次推理最多合并的文本条数
+        self.max_batch_size = max_batch_size
+        # 等待凑批的最长时间（秒）
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor if executor is not None else InferenceExecutor(max_concurrency=1)
+        self.max_queue = max_queue
+        self._queue: asyncio.Queue = None
+        self._slots: asyncio.Semaphore = None
+        self._worker_task: asyncio.Task = None
+        self._flush_tasks = set()
+        # 统计信息
+        self.requests = 0
+        self.batches = 0
+        self.rejected = 0
+        self.total_batch_wait_time = 0.0
+        self.max_batch_wait_time = 0.0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+
+    def start(self):
+        """在事件循环内启动调度协程，需要在服务启动时调用"""
+        self._queue = asyncio.Queue()
+        # 同时在途的batch数和推理线程数保持一致
+        self._slots = asyncio.Semaphore(self.executor.max_concurrency)
+        self._worker_task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker_task is not None:
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown()
+
+    async def embed(self, texts: List[str]):
+        """
+        提交一个请求的文本，等待合批推理完成后返回 (该请求对应的向量矩阵, timing)
+
+        timing 中的 queue_time 是该请求从提交到开始推理的等待时间（凑批+线程池排队），
+        batch_wait_time 是其中在调度器里等待凑批的时间。
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32), {'queue_time': 0.0, 'batch_wait_time': 0.0, 'infer_time': 0.0}
+        if self.max_queue is not None and self._queue.qsize() >= self.max_queue:
+            self.rejected += 1
+            raise InferenceQueueFull(f"embedding queue is full: {self._queue.qsize()} requests waiting")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((texts, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 等待空闲的推理槽位
+            await self._slots.acquire()
+            # 阻塞等待第一个请求，之后在时间窗口内尽量多地收集请求
+            item = await self._queue.get()
+            batch = [item]
+            total = len(item[0])
+            deadline = loop.time() + self.max_wait
+            while total < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                total += len(item[0])
+            task = loop.create_task(self._flush(batch))
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, batch):
+        all_texts = [text for texts, _, _ in batch for text in texts]
+        flush_time = time.perf_counter()
+        self.batches += 1
+        for _, _, submit_time in batch:
+            batch_wait_time = flush_time - submit_time
+            self.requests += 1
+            self.total_batch_wait_time += batch_wait_time
+            self.max_batch_wait_time = max(self.max_batch_wait_time, batch_wait_time)
+        try:
+            embeddings, timing = await self.executor.run(self.backend.predict, all_texts, return_numpy=True)
+        except Exception as e:
+            debug_logger.error(f"batch embedding error: {traceback.format_exc()}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        embed_logger.info(f"merged {len(batch)} requests, {len(all_texts)} texts, "
+                          f"batch wait time: {flush_time - batch[0][2]:.4f}s, "
+                          f"queue time: {timing['queue_time']:.4f}s, infer time: {timing['infer_time']:.4f}s")
+        # 按请求顺序拆分结果，已经被取消的请求（客户端断开）直接跳过
+        offset = 0
+        for texts, future, submit_time in batch:
+            queue_time = timing['start_time'] - submit_time
+            self.total_queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            if not future.done():
+                request_timing = {'queue_time': queue_time, 'batch_wait_time': flush_time - submit_time,
+                                  'infer_time': timing['infer_time']}
+                future.set_result((embeddings[offset:offset + len(texts)], request_timing))
+            offset += len(texts)
+
+    def stats(self) -> dict:
+        requests = max(self.requests, 1)
+        return {"queued": self._queue.qsize() if self._queue is not None else 0, "max_queue": self.max_queue,
+                "requests": self.requests, "batches": self.batches, "rejected": self.rejected,
+                "avg_batch_wait_time": round(self.total_batch_wait_time / requests, 4),
+                "max_batch_wait_time": round(self.max_batch_wait_time, 4),
+                "avg_queue_time": round(self.total_queue_time / requests, 4),
+                "max_queue_time": round(self.max_queue_time, 4)}
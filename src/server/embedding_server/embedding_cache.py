@@ -0,0 +1,123 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from src.utils.cache_utils import LRUCache
+from src.utils.log_handler import debug_logger
+
+
+class EmbeddingCache:
+    """
+    按内容寻址的持久化向量缓存
+
+    key 由 (模型路径, max_length, 文本hash) 计算得到，向量以float32二进制保存在sqlite中，
+    前面再加一层内存LRU。同一个文件重复上传、知识库重建索引时，相同文本的chunk直接命中缓存，
+    不需要重新分词和推理。sqlite使用WAL模式，多个sanic worker进程可以共用同一个缓存文件。
+    sqlite中每行记录最近一次访问时间，行数超过 max_rows 时按访问时间删除最久没用的行，
+    一次删到 max_rows 的90%，max_rows为空时不限制。
+    """
+
+    def __init__(self, db_path: str, model_path: str, max_length: int, memory_size: int = 20000,
+                 max_rows: Optional[int] = 1000000):
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+        # 模型或者截断长度变了，向量也就变了，所以都要参与key的计算
+        self._namespace = f"{model_path}\0{max_length}\0".encode('utf-8')
+        self._memory = LRUCache(memory_size)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                           "(key BLOB PRIMARY KEY, vector BLOB NOT NULL, accessed INTEGER NOT NULL DEFAULT 0)")
+        # 旧版本创建的缓存文件没有访问时间列
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)").fetchall()]
+        if 'accessed' not in columns:
+            self._conn.execute("ALTER TABLE embeddings ADD COLUMN accessed INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_accessed ON embeddings (accessed)")
+        self._conn.commit()
+        self.max_rows = max_rows
+        # 行数的估计值，超过 max_rows 时才重新统计并清理，其他进程写入的行在重新统计时计入
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.disk_hits = 0
+        self.trimmed = 0
+        debug_logger.info(f"EmbeddingCache: db_path: {db_path}, memory_size: {memory_size}, "
+                          f"max_rows: {max_rows}, rows: {self._rows}")
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.md5(self._namespace + text.encode('utf-8')).digest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """批量查询，未命中的位置为None"""
+        keys = [self._key(text) for text in texts]
+        results = [self._memory.get(key) for key in keys]
+        miss = {}
+        for i, (key, value) in enumerate(zip(keys, results)):
+            if value is None:
+                miss.setdefault(key, []).append(i)
+        if not miss:
+            return results
+        miss_keys = list(miss.keys())
+        rows = []
+        with self._lock:
+            # sqlite单条语句的参数个数有限制，分批查询
+            for start in range(0, len(miss_keys), 500):
+                chunk = miss_keys[start:start + 500]
+                placeholders = ','.join(['?'] * len(chunk))
+                rows.extend(self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk).fetchall())
+            if rows and self.max_rows:
+                # 刷新从磁盘命中的行的访问时间，清理时优先保留
+                now = int(time.time())
+                self._conn.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?",
+                                       [(now, key) for key, _ in rows])
+                self._conn.commit()
+        for key, blob in rows:
+            vector = np.frombuffer(blob, dtype=np.float32)
+            self._memory.put(key, vector)
+            for i in miss[key]:
+                results[i] = vector
+        self.disk_hits += len(rows)
+        return results
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        keys = [self._key(text) for text in texts]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        for key, vector in zip(keys, vectors):
+            # 复制一份，内存缓存不引用整个batch的结果矩阵，调用方修改结果也不会影响缓存
+            self._memory.put(key, vector.copy())
+        now = int(time.time())
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)",
+                                   [(key, vector.tobytes(), now) for key, vector in zip(keys, vectors)])
+            self._conn.commit()
+            self._rows += len(keys)
+            if self.max_rows and self._rows > self.max_rows:
+                self._trim()
+
+    def _trim(self):
+        """行数超过 max_rows 时删除最久没有访问的行，调用方持有 self._lock"""
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if self._rows <= self.max_rows:
+            return
+        count = self._rows - int(self.max_rows * 0.9)
+        self._conn.execute("DELETE FROM embeddings WHERE key IN "
+                           "(SELECT key FROM embeddings ORDER BY accessed LIMIT ?)", (count,))
+        self._conn.commit()
+        self._rows -= count
+        self.trimmed += count
+        debug_logger.info(f"EmbeddingCache: trimmed {count} rows, rows: {self._rows}")
+
+    def stats(self) -> dict:
+        stats = self._memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        stats['disk_rows'] = self._rows
+        stats['disk_max_rows'] = self.max_rows
+        stats['disk_trimmed'] = self.trimmed
+        return stats
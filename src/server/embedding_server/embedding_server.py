@@ -10,9 +10,13 @@ root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(curre
 sys.path.append(root_dir)
 
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, raw
 from src.server.embedding_server.embedding_backend import EmbeddingBackend
-from src.configs.configs import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_THREADS
+from src.server.embedding_server.embedding_batcher import EmbeddingBatcher
+from src.utils.inference_executor import InferenceExecutor, InferenceQueueFull
+from src.utils.log_handler import embed_logger
+from src.utils.embedding_codec import BINARY_DTYPES, BINARY_CONTENT_TYPE, encode_embeddings
+from src.configs.configs import LOCAL_EMBED_MODEL_PATH, LOCAL_EMBED_THREADS, LOCAL_EMBED_BATCH
 from src.utils.general_utils import get_time_async
 import argparse
 
@@ -22,6 +26,28 @@ parser = argparse.ArgumentParser()
 # 使用--use_gpu可以让Embedding模型加载到gpu中
 parser.add_argument('--use_gpu', action="store_true", help='use gpu or not')
 parser.add_argument('--workers', type=int, default=1, help='workers')
+# 模型版本，int8需要先运行 src/server/quantize_onnx.py 生成量化模型，纯CPU部署时推理更快
+parser.add_argument('--model_variant', type=str, default='fp32', choices=['fp32', 'int8'], help='onnx model variant')
+# 微批调度等待凑批的最长时间，单位毫秒
+parser.add_argument('--batch_wait_ms', type=float, default=5, help='max wait time (ms) to gather a batch')
+# 同时执行的推理数，大于1时下一批的分词可以和当前批的推理重叠，默认为会话数+1
+parser.add_argument('--infer_concurrency', type=int, default=None, help='max concurrent inference calls')
+# onnx会话池：会话数和每个会话的线程数，不指定时按可用核数自动配置（GPU为1个会话）
+parser.add_argument('--num_sessions', type=int, default=None, help='number of onnx sessions')
+parser.add_argument('--intra_op_threads', type=int, default=None, help='intra-op threads per session')
+# 把每个会话的线程绑定到各自的核上，从可用核中的第core_offset个开始分配，
+# 和其他服务共用机器时给每个服务指定不重叠的core_offset；workers大于1时各个进程无法区分，不绑核
+parser.add_argument('--pin_cores', action="store_true", help='pin session threads to cores')
+parser.add_argument('--core_offset', type=int, default=0, help='first core (index in the affinity mask) to pin')
+# 在微批调度器中排队等待凑批的请求数上限，超过后直接返回503
+parser.add_argument('--max_queue', type=int, default=None, help='max requests waiting in the batcher')
+# 持久化向量缓存的sqlite文件路径，相同文本的向量直接从缓存读取
+parser.add_argument('--cache_path', type=str, default='./embedding_cache/embeddings.db', help='embedding cache path')
+parser.add_argument('--no_cache', action="store_true", help='disable embedding cache')
+# 向量缓存内存层的条目数
+parser.add_argument('--cache_memory_size', type=int, default=20000, help='in-memory embedding cache entries')
+# sqlite向量缓存的最大行数，超过后删除最久没有访问的向量，0为不限制
+parser.add_argument('--cache_max_rows', type=int, default=1000000, help='max rows in the sqlite embedding cache')
 # 检查是否是local或online，不是则报错
 args = parser.parse_args()
 print("args:", args)
@@ -34,17 +60,42 @@ app = Sanic("embedding_server")
 async def embedding(request):
     data = request.json
     texts = data.get('texts')
+    # 可选的二进制响应编码：float32 / float16，默认返回json
+    encoding = data.get('encoding', 'json')
+    if encoding != 'json' and encoding not in BINARY_DTYPES:
+        return json({"msg": f"unsupported encoding: {encoding}"}, status=400)
     # print("local embedding texts number:", len(texts), flush=True)
 
     # onnx_backend: EmbeddingAsyncBackend = request.app.ctx.onnx_backend
-    # onnx后端上下文在这里使用
-    onnx_backend: EmbeddingBackend = request.app.ctx.onnx_backend
-    # result_data = await onnx_backend.embed_documents_async(texts)
-    result_data = onnx_backend.predict(texts)
+    # 交给微批调度器，和其他并发请求合并成一次推理
+    batcher: EmbeddingBatcher = request.app.ctx.batcher
+    try:
+        result_data, timing = await batcher.embed(texts)
+    except InferenceQueueFull as e:
+        return json({"msg": str(e)}, status=503)
     # print("local embedding result number:", len(result_data), flush=True)
     # print("local embedding result:", result_data, flush=True)
+    embed_logger.info(f"embedding texts number: {len(texts)}, queue time: {timing['queue_time']:.4f}s "
+                      f"(batch wait: {timing['batch_wait_time']:.4f}s), infer time: {timing['infer_time']:.4f}s")
 
-    return json(result_data)
+    headers = {"X-Queue-Time": f"{timing['queue_time']:.4f}", "X-Batch-Wait-Time": f"{timing['batch_wait_time']:.4f}",
+               "X-Infer-Time": f"{timing['infer_time']:.4f}"}
+    if encoding != 'json' and len(result_data):
+        # 直接返回小端序的原始字节，省去json的序列化和解析
+        body, binary_headers = encode_embeddings(result_data, encoding)
+        headers.update(binary_headers)
+        return raw(body, content_type=BINARY_CONTENT_TYPE, headers=headers)
+    return json(result_data.tolist(), headers=headers)
+
+
+@app.route("/health", methods=["GET"])
+async def health(request):
+    # 推理在线程池中执行，推理繁忙时健康检查也能立即返回
+    return json({"code": 200, "msg": "success", "model_path": request.app.ctx.onnx_backend.model_path,
+                 "batcher": request.app.ctx.batcher.stats(),
+                 "executor": request.app.ctx.executor.stats(),
+                 "sessions": request.app.ctx.onnx_backend.session_stats(),
+                 "embedding_cache": request.app.ctx.onnx_backend.cache_stats()})
 
 
 @app.listener('before_server_start')
@@ -53,7 +104,25 @@ async def setup_onnx_backend(app, loop):
     #                                              use_cpu=not args.use_gpu, num_threads=LOCAL_EMBED_THREADS)
     # onnx_backend 是在应用启动时被初始化并存储在上下文中的对象
     # 存储到应用上下文
-    app.ctx.onnx_backend = EmbeddingBackend(use_cpu=not args.use_gpu)
+    app.ctx.onnx_backend = EmbeddingBackend(use_cpu=not args.use_gpu, model_variant=args.model_variant,
+                                            num_sessions=args.num_sessions, intra_op_threads=args.intra_op_threads,
+                                            pin_cores=args.pin_cores and args.workers <= 1,
+                                            core_offset=args.core_offset,
+                                            cache_path=None if args.no_cache else args.cache_path,
+                                            cache_memory_size=args.cache_memory_size,
+                                            cache_max_rows=args.cache_max_rows)
+    # 微批调度器，凑满LOCAL_EMBED_BATCH或等待batch_wait_ms后统一推理
+    infer_concurrency = args.infer_concurrency or app.ctx.onnx_backend.session_stats()['num_sessions'] + 1
+    # 同时在途的batch数不超过推理线程数，请求只会在调度器里排队，排队上限由调度器控制
+    app.ctx.executor = InferenceExecutor(max_concurrency=infer_concurrency, name='embedding')
+    app.ctx.batcher = EmbeddingBatcher(app.ctx.onnx_backend, LOCAL_EMBED_BATCH, args.batch_wait_ms,
+                                       executor=app.ctx.executor, max_queue=args.max_queue)
+    app.ctx.batcher.start()
+
+
+@app.listener('after_server_stop')
+async def stop_batcher(app, loop):
+    await app.ctx.batcher.stop()
 
 
 if __name__ == "__main__":
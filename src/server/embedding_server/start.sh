@@ -19,9 +19,10 @@ if [ ! -f "embedding_server.py" ]; then
     exit 1
 fi
 
-# 启动embedding服务
+# 启动embedding服务，脚本参数原样传给embedding_server.py
+# 例如和另一个服务共用机器时绑核：./start.sh --pin_cores --core_offset 8 --num_sessions 1 --intra_op_threads 8
 echo "Starting embedding server with nohup..."
-nohup python embedding_server.py > record.log 2>&1 &
+nohup python embedding_server.py "$@" > record.log 2>&1 &
 
 # 获取后台进程的PID
 EMBEDDING_PID=$!
@@ -0,0 +1,124 @@
+import sys
+import os
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+
+sys.path.append(root_dir)
+
+from src.core.qa_handler import QAHandler
+from src.utils.log_handler import insert_logger
+import multiprocessing
+import traceback
+import argparse
+import asyncio
+import socket
+import time
+import uuid
+
+# 后台入库worker：轮询File表中status为gray的文件，领取后解析、向量化并写入milvus/es/mysql
+# 文件状态：gray 等待入库，yellow 入库中，green 入库成功，red 重试多次后仍然失败
+parser = argparse.ArgumentParser()
+# 进程数，解析和切分是CPU密集的操作，多进程可以用上多个核
+parser.add_argument('--workers', type=int, default=1, help='worker processes')
+# 每个进程同时入库的文件数，向量化和数据库写入都是IO等待，多个文件可以重叠执行
+parser.add_argument('--concurrency', type=int, default=4, help='files ingested concurrently per process')
+# 没有待入库文件时的轮询间隔（秒）
+parser.add_argument('--poll_interval', type=float, default=2, help='poll interval in seconds')
+# 入库失败后的最大重试次数，超过后文件标记为red
+parser.add_argument('--max_retries', type=int, default=3, help='max retries before a file is marked failed')
+# yellow状态超过该时间（秒）的文件认为worker已经退出，重新放回队列
+parser.add_argument('--stale_timeout', type=int, default=1800, help='requeue files claimed longer ago than this')
+args = parser.parse_args()
+
+
+async def heartbeat_loop(mysql_client, file_id: str, worker_id: str):
+    """入库期间定期刷新文件的领取时间，处理时间长的文件不会被 reset_stale_loop 放回队列"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(max(args.stale_timeout / 3, args.poll_interval))
+        try:
+            if not await loop.run_in_executor(None, mysql_client.touch_file, file_id, worker_id):
+                insert_logger.warning(f"{worker_id} heartbeat for {file_id} updated nothing, claim may be lost")
+        except Exception:
+            insert_logger.error(f"{worker_id} heartbeat {file_id} error: {traceback.format_exc()}")
+
+
+async def ingest_loop(qa_handler: QAHandler, worker_id: str):
+    """不断领取并入库文件，直到进程退出"""
+    mysql_client = qa_handler.mysql_client
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            row = await loop.run_in_executor(None, mysql_client.claim_file, worker_id)
+        except Exception:
+            insert_logger.error(f"{worker_id} claim file error: {traceback.format_exc()}")
+            row = None
+        if row is None:
+            await asyncio.sleep(args.poll_interval)
+            continue
+        file_id = row['file_id']
+        insert_logger.info(f"{worker_id} start ingest {row['file_name']} ({file_id}), retry: {row['retry_count']}")
+        start_time = time.perf_counter()
+        heartbeat = asyncio.create_task(heartbeat_loop(mysql_client, file_id, worker_id))
+        try:
+            chunks_number = await qa_handler.ingest_file(file_id, row['user_id'], row['kb_id'], row['file_name'],
+                                                         row['file_location'], row['chunk_size'])
+        except Exception as e:
+            insert_logger.error(f"{worker_id} ingest {file_id} error: {traceback.format_exc()}")
+            if not await loop.run_in_executor(None, mysql_client.retry_or_fail_file, file_id, str(e)[:1000],
+                                              args.max_retries, worker_id):
+                insert_logger.warning(f"{worker_id} lost claim of {file_id}, failure not recorded")
+            continue
+        finally:
+            heartbeat.cancel()
+        # 只有文件仍被本worker领取时才标记成功，超时后被其他worker重新领取的文件以新的worker为准
+        if not await loop.run_in_executor(None, mysql_client.update_file_status, file_id, 'green', 'success',
+                                          worker_id):
+            insert_logger.warning(f"{worker_id} lost claim of {file_id}, status left to the new owner")
+            continue
+        insert_logger.info(f"{worker_id} ingest {row['file_name']} ({file_id}) success, "
+                           f"chunks: {chunks_number}, cost: {time.perf_counter() - start_time:.2f}s")
+
+
+async def reset_stale_loop(qa_handler: QAHandler):
+    """把长时间处于yellow状态的文件放回队列，worker重启或者崩溃后可以继续入库"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            count = await loop.run_in_executor(None, qa_handler.mysql_client.reset_stale_files, args.stale_timeout)
+            if count:
+                insert_logger.info(f"requeue {count} stale files")
+        except Exception:
+            insert_logger.error(f"reset stale files error: {traceback.format_exc()}")
+        await asyncio.sleep(max(args.stale_timeout / 2, args.poll_interval))
+
+
+async def run_worker():
+    qa_handler = QAHandler(None)
+    qa_handler.init_cfg(args)
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    tasks = [asyncio.create_task(reset_stale_loop(qa_handler))]
+    tasks += [asyncio.create_task(ingest_loop(qa_handler, f"{prefix}:{uuid.uuid4().hex[:8]}"))
+              for _ in range(args.concurrency)]
+    insert_logger.info(f"ingest worker {prefix} started, concurrency: {args.concurrency}")
+    await asyncio.gather(*tasks)
+
+
+def main():
+    asyncio.run(run_worker())
+
+
+if __name__ == "__main__":
+    print("args:", args)
+    if args.workers <= 1:
+        main()
+    else:
+        processes = [multiprocessing.Process(target=main) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
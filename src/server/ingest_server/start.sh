@@ -0,0 +1,40 @@
+#!/bin/bash
+# 入库 worker 启动脚本
+
+echo "Starting ingest worker..."
+
+# 检查是否已经有入库worker在运行
+if [ -f "ingest.pid" ] && kill -0 $(cat ingest.pid) > /dev/null 2>&1; then
+    echo "Warning: ingest worker is already running with PID: $(cat ingest.pid)"
+    echo "Please stop the existing worker first"
+    exit 1
+fi
+
+# 检查ingest_worker.py是否存在
+if [ ! -f "ingest_worker.py" ]; then
+    echo "Error: ingest_worker.py not found in current directory"
+    exit 1
+fi
+
+# 启动入库worker，参数原样传给ingest_worker.py
+echo "Starting ingest worker with nohup..."
+nohup python ingest_worker.py "$@" > record.log 2>&1 &
+
+# 获取后台进程的PID
+INGEST_PID=$!
+echo "Ingest worker started with PID: $INGEST_PID"
+
+# 将PID保存到文件中，方便后续管理
+echo $INGEST_PID > ingest.pid
+echo "PID saved to ingest.pid file"
+
+# 等待几秒钟检查是否启动成功
+sleep 5
+if kill -0 $INGEST_PID > /dev/null 2>&1; then
+    echo "✓ Ingest worker started successfully"
+    echo "✓ Log file: record.log"
+else
+    echo "✗ Failed to start ingest worker"
+    echo "Check the log file for errors: record.log"
+    exit 1
+fi
@@ -0,0 +1,81 @@
+import sys
+import os
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))
+
+sys.path.append(root_dir)
+
+import argparse
+import time
+
+# 支持的模型版本：fp32为export_onnx.py导出的原始模型，int8为动态量化后的模型
+MODEL_VARIANTS = ('fp32', 'int8')
+
+
+def get_model_path(model_path: str, variant: str = 'fp32') -> str:
+    """
+    根据模型版本得到onnx文件路径
+
+    量化模型和原模型放在同一目录下，文件名加上版本后缀，例如 model.onnx -> model.int8.onnx。
+    """
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"unsupported model variant: {variant}, must be one of {MODEL_VARIANTS}")
+    if variant == 'fp32':
+        return model_path
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.{variant}{ext}"
+
+
+def quantize_model(model_path: str, output_path: str = None, per_channel: bool = True,
+                   reduce_range: bool = False, preprocess: bool = True) -> str:
+    """
+    对onnx模型做INT8动态量化
+
+    权重离线量化为int8，激活在推理时按batch动态计算scale，不需要校准数据。
+    只量化MatMul/Gemm，LayerNorm、Softmax等保持fp32，对bert类模型精度影响最小。
+    reduce_range 使用7bit权重，在不支持VNNI的老CPU上可以避免int8乘加溢出。
+    """
+    # 量化依赖onnx包，只有离线转换时才需要，服务运行时不导入
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    output_path = output_path or get_model_path(model_path, 'int8')
+    input_path = model_path
+    if preprocess:
+        # 量化前先做图优化和shape推断，量化效果更好
+        input_path = f"{os.path.splitext(output_path)[0]}.pre.onnx"
+        quant_pre_process(model_path, input_path, skip_symbolic_shape=True)
+    start_time = time.time()
+    quantize_dynamic(input_path, output_path,
+                     op_types_to_quantize=['MatMul', 'Gemm'],
+                     per_channel=per_channel,
+                     reduce_range=reduce_range,
+                     weight_type=QuantType.QInt8)
+    if preprocess:
+        os.remove(input_path)
+    print(f"quantized {model_path} -> {output_path}, cost {time.time() - start_time:.2f}s, "
+          f"size: {os.path.getsize(model_path) / 1024 ** 2:.1f}MB -> {os.path.getsize(output_path) / 1024 ** 2:.1f}MB")
+    return output_path
+
+
+if __name__ == "__main__":
+    from src.configs.configs import LOCAL_EMBED_MODEL_PATH, LOCAL_RERANK_MODEL_PATH
+
+    parser = argparse.ArgumentParser()
+    # 要量化的模型：embedding、rerank或者全部
+    parser.add_argument('--model', type=str, default='all', choices=['embedding', 'rerank', 'all'],
+                        help='which model to quantize')
+    parser.add_argument('--no_per_channel', action="store_true", help='quantize weights per tensor')
+    parser.add_argument('--reduce_range', action="store_true", help='use 7-bit weights for CPUs without VNNI')
+    parser.add_argument('--no_preprocess', action="store_true", help='skip onnx pre-processing before quantization')
+    args = parser.parse_args()
+
+    model_paths = {'embedding': LOCAL_EMBED_MODEL_PATH, 'rerank': LOCAL_RERANK_MODEL_PATH}
+    for name, path in model_paths.items():
+        if args.model in (name, 'all'):
+            quantize_model(path, per_channel=not args.no_per_channel, reduce_range=args.reduce_range,
+                           preprocess=not args.no_preprocess)
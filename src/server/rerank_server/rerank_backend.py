@@ -1,13 +1,14 @@
 from transformers import AutoTokenizer
-from copy import deepcopy
 from typing import List
 from src.configs.configs import LOCAL_RERANK_MAX_LENGTH, \
-    LOCAL_RERANK_BATCH, RERANK_MODEL_PATH, LOCAL_RERANK_THREADS, \
+    LOCAL_RERANK_BATCH, RERANK_MODEL_PATH, \
     LOCAL_RERANK_MODEL_PATH
 from src.utils.log_handler import debug_logger
 from src.utils.general_utils import get_time
+from src.utils.cache_utils import TokenCache, LRUCache, text_hash, normalize_query
+from src.utils.session_pool import SessionPool
+from src.server.quantize_onnx import get_model_path
 import concurrent.futures
-import onnxruntime
 import numpy as np
 
 
@@ -19,28 +20,40 @@ def sigmoid(x):
 
 
 class RerankBackend():
-    def __init__(self, use_cpu: bool = False):
+    def __init__(self, use_cpu: bool = False, model_variant: str = 'fp32', num_sessions: int = None,
+                 intra_op_threads: int = None, pin_cores: bool = False, core_offset: int = 0,
+                 score_cache_size: int = 100000, score_cache_ttl: float = 3600):
         self._tokenizer = AutoTokenizer.from_pretrained(RERANK_MODEL_PATH)
         self.spe_id = self._tokenizer.sep_token_id
+        # 模型是否需要token_type_ids输入
+        self.with_token_type = 'token_type_ids' in self._tokenizer.model_input_names
+        # 分词结果缓存，同一知识库的passage在不同query下会被反复rerank
+        self._token_cache = TokenCache(self._tokenizer)
+        # rerank分数缓存，key为 (模型, 归一化query的hash, passage的hash)，
+        # 用户对同一个知识库重复提问时相同的 (query, passage) 不再重新推理，score_cache_size为0时不启用
+        self._score_cache = LRUCache(score_cache_size, ttl=score_cache_ttl) if score_cache_size else None
         # 设置重叠长度，80，方便记录上下文
         self.overlap_tokens = 80
         self.batch_size = LOCAL_RERANK_BATCH
         self.max_length = LOCAL_RERANK_MAX_LENGTH
         self.return_tensors = None
-        self.workers = LOCAL_RERANK_THREADS
         self.use_cpu = use_cpu
         self.return_tensors = "np"
-        # 创建一个ONNX Runtime会话设置，使用GPU执行
-        sess_options = onnxruntime.SessionOptions()
-        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        sess_options.intra_op_num_threads = 0
-        sess_options.inter_op_num_threads = 0
+        # 模型版本，int8为quantize_onnx.py生成的动态量化模型，适合纯CPU部署
+        self.model_path = get_model_path(LOCAL_RERANK_MODEL_PATH, model_variant)
         if use_cpu:
             providers = ['CPUExecutionProvider']
         else:
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        self.session = onnxruntime.InferenceSession(
-            LOCAL_RERANK_MODEL_PATH, sess_options, providers=providers)
+        # 推理会话池，每个会话独占一部分核，会话数和线程数为空时按可用核数自动配置
+        self.session = SessionPool(self.model_path, providers, num_sessions=num_sessions,
+                                   intra_op_threads=intra_op_threads, pin_cores=pin_cores,
+                                   core_offset=core_offset, name='rerank')
+        # 同时推理的batch数和会话数一致，多了只会在会话池上排队
+        self.workers = self.session.size
+        self._batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                     thread_name_prefix='rerank_batch')
+        debug_logger.info(f"RerankBackend: model_path: {self.model_path}")
     # 推理
 
     def inference(self, batch):
@@ -65,39 +78,21 @@ class RerankBackend():
         # 5. 整理输出格式，转换为一维
         return sigmoid_scores.reshape(-1).tolist()
 
-    def merge_inputs(self, chunk1_raw, chunk2):
-        chunk1 = deepcopy(chunk1_raw)
-
-        # 在 chunk1 的末尾添加分隔符
-        chunk1['input_ids'].append(self.spe_id)
-        chunk1['attention_mask'].append(1)  # 为分隔符添加 attention mask
-
-        # 添加 chunk2 的内容
-        chunk1['input_ids'].extend(chunk2['input_ids'])
-        chunk1['attention_mask'].extend(chunk2['attention_mask'])
-
-        # 在整个序列的末尾再添加一个分隔符
-        chunk1['input_ids'].append(self.spe_id)
-        chunk1['attention_mask'].append(1)  # 为最后的分隔符添加 attention mask
-
-        if 'token_type_ids' in chunk1:
-            # 为 chunk2 和两个分隔符添加 token_type_ids
-            token_type_ids = [1 for _ in range(
-                len(chunk2['token_type_ids']) + 2)]
-            chunk1['token_type_ids'].extend(token_type_ids)
-
-        return chunk1
-    # 处理长文本重排序的预处理函数，将query和passages转换为模型可以处理的格式。
-
     def tokenize_preproc(self,
                          query: str,
                          passages: List[str]):
-        # 先对query进行编码
-        query_inputs = self._tokenizer.encode_plus(
-            query, truncation=False, padding=False)
+        """
+        处理长文本重排序的预处理，返回 (query的input_ids, 窗口列表, 窗口对应的原始passage索引)
+
+        passage的分词走分词缓存，未命中的合并成一次fast tokenizer调用；
+        过长的passage按滑动窗口切分，窗口只是分词结果上的numpy切片，不复制也不拼接query，
+        真正的 [query, sep, passage, sep] 在 build_batch 中直接写入预分配的数组。
+        """
+        # 先对query进行编码，带特殊token，例如 <s> query </s>
+        query_ids = np.asarray(self._tokenizer(query, truncation=False, padding=False)['input_ids'],
+                               dtype=np.int64)
         # 计算passage最大长度，减2是因为添加了两个分隔符
-        max_passage_inputs_length = self.max_length - \
-            len(query_inputs['input_ids']) - 2
+        max_passage_inputs_length = self.max_length - len(query_ids) - 2
         # 例如：
         # self.max_length = 512
         # query长度 = 30
@@ -108,82 +103,201 @@ class RerankBackend():
         overlap_tokens = min(self.overlap_tokens,
                              max_passage_inputs_length * 2 // 7)
 
-        # 组[query, passage]对
-        merge_inputs = []
-        merge_inputs_idxs = []
-        for pid, passage in enumerate(passages):
-            # 对passage进行编码
-            passage_inputs = self._tokenizer.encode_plus(passage, truncation=False, padding=False,
-                                                         add_special_tokens=False)
-            # 编码长度
-            passage_inputs_length = len(passage_inputs['input_ids'])
-            # 当passage长度小于最大允许长度时
-            if passage_inputs_length <= max_passage_inputs_length:
-                if passage_inputs['attention_mask'] is None or len(passage_inputs['attention_mask']) == 0:
-                    continue
-                # 直接合并query和passage
-                qp_merge_inputs = self.merge_inputs(
-                    query_inputs, passage_inputs)
-                merge_inputs.append(qp_merge_inputs)
-                # print("query ids: ",query_inputs)
-                # print("passage ids: ",passage_inputs)
-                # print(query, " " , passage)
-                # print(qp_merge_inputs)
-                # 记录原始passage的索引，排序用
-                merge_inputs_idxs.append(pid)
-            else:
-                # 当passage过长时，需要分段处理
-                start_id = 0
-                while start_id < passage_inputs_length:
-                    # 切分passage
-                    end_id = start_id + max_passage_inputs_length
-                    # 提取子段
-                    sub_passage_inputs = {k: v[start_id:end_id]
-                                          for k, v in passage_inputs.items()}
-                    # 计算下一段的开始位置（考虑重叠）
-                    start_id = end_id - overlap_tokens if end_id < passage_inputs_length else end_id
-                    # query和子段合并
-                    qp_merge_inputs = self.merge_inputs(
-                        query_inputs, sub_passage_inputs)
-                    # 放入合并后的
-                    merge_inputs.append(qp_merge_inputs)
-                    # 记录原始索引
-                    merge_inputs_idxs.append(pid)
-        # 返回合并后的输入，和记录的原始索引位置
-        return merge_inputs, merge_inputs_idxs
+        windows = []
+        windows_idxs = []
+        # 从分词缓存批量获取passage的input_ids（不带特殊token）
+        for pid, passage_ids in enumerate(self._token_cache.encode_arrays(passages)):
+            passage_ids = np.frombuffer(passage_ids, dtype=np.intc)
+            passage_inputs_length = len(passage_ids)
+            if passage_inputs_length == 0:
+                continue
+            # 当passage长度小于最大允许长度时整段作为一个窗口，否则分段处理
+            start_id = 0
+            while start_id < passage_inputs_length:
+                end_id = start_id + max_passage_inputs_length
+                windows.append(passage_ids[start_id:end_id])
+                # 记录原始passage的索引，同一passage的多个窗口最后取最高分
+                windows_idxs.append(pid)
+                # 计算下一段的开始位置（考虑重叠）
+                start_id = end_id - overlap_tokens if end_id < passage_inputs_length else end_id
+        return query_ids, windows, windows_idxs
+
+    def build_batch(self, query_ids: np.ndarray, windows: List[np.ndarray]):
+        """把一批窗口拼成 [query, sep, passage, sep] 并padding，直接写入预分配的数组"""
+        query_length = len(query_ids)
+        lengths = [query_length + len(window) + 2 for window in windows]
+        shape = (len(windows), max(lengths))
+        input_ids = np.full(shape, self._tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros(shape, dtype=np.int64)
+        input_ids[:, :query_length] = query_ids
+        input_ids[:, query_length] = self.spe_id
+        for row, (window, length) in enumerate(zip(windows, lengths)):
+            input_ids[row, query_length + 1:length - 1] = window
+            input_ids[row, length - 1] = self.spe_id
+            attention_mask[row, :length] = 1
+        batch = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if self.with_token_type:
+            # query部分为0，分隔符和passage部分为1，padding部分为0
+            token_type_ids = attention_mask.copy()
+            token_type_ids[:, :query_length] = 0
+            batch['token_type_ids'] = token_type_ids
+        return batch
+
+    def _score_keys(self, query: str, passages: List[str]):
+        query_hash = text_hash(normalize_query(query))
+        return [(self.model_path, query_hash, text_hash(passage)) for passage in passages]
 
     @get_time
     def get_rerank(self, query: str, passages: List[str]):
-        tot_batches, merge_inputs_idxs_sort = self.tokenize_preproc(
-            query, passages)
-
-        tot_scores = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
-            futures = []
-            for k in range(0, len(tot_batches), self.batch_size):
-                batch = self._tokenizer.pad(
-                    tot_batches[k:k + self.batch_size],
-                    padding=True,
-                    max_length=None,
-                    pad_to_multiple_of=None,
-                    return_tensors=self.return_tensors
-                )
-                future = executor.submit(self.inference, batch)
-                futures.append(future)
-            # debug_logger.info(f'rerank number: {len(futures)}')
-            for future in futures:
-                scores = future.result()
-                # todo
-                tot_scores.extend(scores)
-                # print(len(scores))
-                # print(scores[:5])
-        # 对于被分段的文档，取分段的最高分数
-        # print("passages len: ", len(passages))
-        # print("merge inputs idx sort: ", len(merge_inputs_idxs_sort))
-        # print("tot_scores: ", len(tot_scores))
+        if self._score_cache is None:
+            return self._compute_rerank(query, passages)
+        # 先查缓存，只把未命中的passage送去推理
+        keys = self._score_keys(query, passages)
+        scores = [self._score_cache.get(key) for key in keys]
+        miss_idx = [i for i, score in enumerate(scores) if score is None]
+        if miss_idx:
+            miss_scores = self._compute_rerank(query, [passages[i] for i in miss_idx])
+            for i, score in zip(miss_idx, miss_scores):
+                self._score_cache.put(keys[i], score)
+                scores[i] = score
+        debug_logger.info(f"rerank score cache: {len(passages) - len(miss_idx)}/{len(passages)} hit")
+        return scores
 
+    def _compute_rerank(self, query: str, passages: List[str]):
+        query_ids, windows, windows_idxs = self.tokenize_preproc(query, passages)
+        tot_scores = self._score_windows(query_ids, windows)
+        # 对于被分段的文档，取分段的最高分数
         merge_tot_scores = [0 for _ in range(len(passages))]
-        for pid, score in zip(merge_inputs_idxs_sort, tot_scores):
+        for pid, score in zip(windows_idxs, tot_scores):
             merge_tot_scores[pid] = max(merge_tot_scores[pid], score)
-        # print("merge_tot_scores:", merge_tot_scores, flush=True)
         return merge_tot_scores
+
+    def _score_windows(self, query_ids: np.ndarray, windows: List[np.ndarray]) -> List[float]:
+        """对一组窗口推理打分，返回和windows顺序一致的分数"""
+        # 按长度排序后再切batch，长度相近的窗口分到同一个batch，减少padding
+        order = sorted(range(len(windows)), key=lambda i: len(windows[i]))
+        # 各个batch提交到常驻线程池，每个batch从会话池借出独立的会话推理
+        futures = []
+        for k in range(0, len(order), self.batch_size):
+            batch = self.build_batch(query_ids, [windows[i] for i in order[k:k + self.batch_size]])
+            futures.append(self._batch_executor.submit(self.inference, batch))
+        scores = [0.0] * len(windows)
+        sorted_scores = [score for future in futures for score in future.result()]
+        for i, score in zip(order, sorted_scores):
+            scores[i] = score
+        return scores
+
+    @staticmethod
+    def filter_topk(scores: List[float], top_k: int, score_threshold: float = 0.0,
+                    relative_threshold: float = None) -> List[int]:
+        """
+        问答流程的过滤规则，返回保留的passage索引，按分数从高到低排序
+
+        先保留分数 >= score_threshold 的passage（都不满足时不过滤），
+        再去掉比最高分低 relative_threshold 以上的，最后取前 top_k 个。
+        """
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        if score_threshold and any(scores[i] >= score_threshold for i in ranked):
+            ranked = [i for i in ranked if scores[i] >= score_threshold]
+        if relative_threshold is not None and ranked and scores[ranked[0]] > 0:
+            min_score = scores[ranked[0]] * (1 - relative_threshold)
+            ranked = [i for i in ranked if scores[i] >= min_score]
+        return ranked[:top_k]
+
+    @get_time
+    def get_rerank_topk(self, query: str, passages: List[str], top_k: int,
+                        score_threshold: float = 0.0, relative_threshold: float = None,
+                        hints: List[float] = None, exact_scores: bool = True):
+        """
+        只返回最终会被保留的passage，返回 [(passage索引, 分数)]，按分数从高到低排序，过滤规则见 filter_topk
+
+        exact_scores 为True（默认）时所有passage都完整打分（走分数缓存），结果和 get_rerank 后再过滤完全一致。
+
+        exact_scores 为False时可以跳过一部分窗口：passage的分数是各个窗口分数的最大值，已算出的分数是最终分数的下界。
+        第一轮给每个passage的第一个窗口打分，之后已经在top_k里、并且下界已经确定能通过过滤的passage不再计算后面的窗口，
+        其余的passage必须算完。sigmoid分数不超过1，最高分也不超过1，所以下界 >= max(score_threshold, 1 - relative_threshold)
+        的passage无论最终分数是多少都能通过两个阈值。有相对阈值时，如果某个算完的passage落在过滤线可能的范围内
+        （过滤线取决于还没算完的最高分），继续计算被跳过的passage，直到过滤线能确定。
+        这样保留下来的集合和全量计算一致，但跳过了窗口的passage返回的是分数下界（不低于上面的阈值），
+        排序也按下界。hints为检索分数，跳过窗口时按hints从高到低的顺序安排推理。
+        """
+        if exact_scores:
+            scores = self.get_rerank(query, passages)
+            return [(i, scores[i]) for i in self.filter_topk(scores, top_k, score_threshold, relative_threshold)]
+
+        num = len(passages)
+        scores = [0.0] * num
+        keys = self._score_keys(query, passages) if self._score_cache is not None else None
+        # 每个passage还没计算的窗口
+        pending = {}
+        miss_idx = list(range(num))
+        if keys is not None:
+            miss_idx = []
+            for i, key in enumerate(keys):
+                cached = self._score_cache.get(key)
+                if cached is None:
+                    miss_idx.append(i)
+                else:
+                    scores[i] = cached
+        query_ids = None
+        if miss_idx:
+            query_ids, windows, windows_idxs = self.tokenize_preproc(query, [passages[i] for i in miss_idx])
+            for window, idx in zip(windows, windows_idxs):
+                pending.setdefault(miss_idx[idx], []).append(window)
+        if hints is not None:
+            priority = sorted(pending, key=lambda i: hints[i], reverse=True)
+        else:
+            priority = sorted(pending)
+
+        # 下界达到该值的passage最终一定能通过阈值过滤
+        certain_score = score_threshold if relative_threshold is None else max(score_threshold, 1 - relative_threshold)
+        total_windows = sum(len(windows) for windows in pending.values())
+        scored_windows = 0
+        first_round = True
+        while pending:
+            if first_round:
+                todo = [i for i in priority if i in pending]
+                first_round = False
+            else:
+                # 在top_k里并且一定能通过阈值的passage可以跳过；下界还没过阈值的要继续算，
+                # 否则它之后过了阈值会让阈值过滤生效，把其他passage过滤掉
+                kept = {i for i in self.filter_topk(scores, top_k, score_threshold, relative_threshold)
+                        if scores[i] >= certain_score}
+                todo = [i for i in priority if i in pending and i not in kept]
+                if not todo and self._relative_cutoff_undecided(scores, pending, score_threshold,
+                                                                relative_threshold):
+                    todo = [i for i in priority if i in pending]
+            if not todo:
+                break
+            # 每个passage本轮只计算下一个窗口
+            round_scores = self._score_windows(query_ids, [pending[i].pop(0) for i in todo])
+            scored_windows += len(todo)
+            for i, score in zip(todo, round_scores):
+                scores[i] = max(scores[i], score)
+                if not pending[i]:
+                    del pending[i]
+                    # 所有窗口都算完的分数才是准确的，可以放进缓存
+                    if keys is not None:
+                        self._score_cache.put(keys[i], scores[i])
+        debug_logger.info(f"rerank topk: {scored_windows}/{total_windows} windows scored, "
+                          f"{num - len(miss_idx)}/{num} passages from cache")
+        return [(i, scores[i]) for i in self.filter_topk(scores, top_k, score_threshold, relative_threshold)]
+
+    @staticmethod
+    def _relative_cutoff_undecided(scores, pending, score_threshold, relative_threshold):
+        """
+        还有passage没算完时，相对阈值的过滤线在 [当前最高分 * (1 - relative_threshold), 1 - relative_threshold] 之间，
+        已经算完的passage落在这个范围内时，是否保留取决于最高分的准确值
+        """
+        if relative_threshold is None or not pending:
+            return False
+        low = max(scores) * (1 - relative_threshold)
+        high = 1 - relative_threshold
+        return any(low <= score < high and score >= score_threshold
+                   for i, score in enumerate(scores) if i not in pending)
+
+    def session_stats(self):
+        return self.session.stats()
+
+    def score_cache_stats(self):
+        return self._score_cache.stats() if self._score_cache is not None else None
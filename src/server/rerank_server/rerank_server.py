@@ -12,15 +12,35 @@ sys.path.append(root_dir)
 from sanic import Sanic
 from sanic.response import json
 from src.server.rerank_server.rerank_backend import RerankBackend
-from src.configs.configs import LOCAL_RERANK_MODEL_PATH, LOCAL_RERANK_THREADS
+from src.utils.inference_executor import InferenceExecutor, InferenceQueueFull
+from src.utils.log_handler import rerank_logger
+from src.configs.configs import LOCAL_RERANK_MODEL_PATH, LOCAL_RERANK_THREADS, LOCAL_RERANK_BATCH
 from src.utils.general_utils import get_time_async
 import argparse
+import asyncio
+import json as jsonlib
 
 # 接收外部参数mode
 parser = argparse.ArgumentParser()
 # mode必须是local或online
 parser.add_argument('--use_gpu', action="store_true", help='use gpu or not')
 parser.add_argument('--workers', type=int, default=1, help='workers')
+# 模型版本，int8需要先运行 src/server/quantize_onnx.py 生成量化模型，纯CPU部署时推理更快
+parser.add_argument('--model_variant', type=str, default='fp32', choices=['fp32', 'int8'], help='onnx model variant')
+# 同时执行的rerank请求数，大于1时下一个请求的分词可以和当前请求的推理重叠
+parser.add_argument('--infer_concurrency', type=int, default=2, help='max concurrent inference calls')
+# onnx会话池：会话数和每个会话的线程数，不指定时按可用核数自动配置（GPU为1个会话）
+parser.add_argument('--num_sessions', type=int, default=None, help='number of onnx sessions')
+parser.add_argument('--intra_op_threads', type=int, default=None, help='intra-op threads per session')
+# 把每个会话的线程绑定到各自的核上，从可用核中的第core_offset个开始分配，
+# 和其他服务共用机器时给每个服务指定不重叠的core_offset；workers大于1时各个进程无法区分，不绑核
+parser.add_argument('--pin_cores', action="store_true", help='pin session threads to cores')
+parser.add_argument('--core_offset', type=int, default=0, help='first core (index in the affinity mask) to pin')
+# rerank分数缓存的条目数和过期时间（秒），条目数为0时不启用
+parser.add_argument('--score_cache_size', type=int, default=100000, help='rerank score cache entries')
+parser.add_argument('--score_cache_ttl', type=float, default=3600, help='rerank score cache ttl in seconds')
+# 排队等待推理的请求上限，超过后直接返回503
+parser.add_argument('--max_queue', type=int, default=None, help='max queued inference requests')
 # 检查是否是local或online，不是则报错
 args = parser.parse_args()
 print("args:", args)
@@ -40,18 +60,110 @@ async def rerank(request):
     # onnx_backend: RerankAsyncBackend = request.app.ctx.onnx_backend
 
     # result_data = await onnx_backend.get_rerank_async(query, passages)
-    result_data = onnx_backend.get_rerank(query, passages)
+    # 推理放到线程池中执行，不阻塞事件循环
+    executor: InferenceExecutor = request.app.ctx.executor
+    try:
+        result_data, timing = await executor.run(onnx_backend.get_rerank, query, passages)
+    except InferenceQueueFull as e:
+        return json({"msg": str(e)}, status=503)
     # print("local rerank query:", query, flush=True)
     # print("local rerank passages number:", len(passages), flush=True)
+    rerank_logger.info(f"rerank passages number: {len(passages)}, queue time: {timing['queue_time']:.4f}s, "
+                       f"infer time: {timing['infer_time']:.4f}s")
 
-    return json(result_data)
+    return json(result_data, headers={"X-Queue-Time": f"{timing['queue_time']:.4f}",
+                                      "X-Infer-Time": f"{timing['infer_time']:.4f}"})
+
+
+@app.route("/rerank_stream", methods=["POST"])
+async def rerank_stream(request):
+    """
+    流式返回rerank分数，响应为NDJSON
+
+    passages按 chunk_size 切块并发推理，哪块先算完就先返回哪块，每行为
+    {"start": 该块第一个passage的位置, "scores": [...]}，推理失败的块返回 {"start": ..., "error": ...}。
+    """
+    data = request.json
+    query = data.get('query')
+    passages = data.get('passages')
+    chunk_size = data.get('chunk_size') or LOCAL_RERANK_BATCH
+    onnx_backend: RerankBackend = request.app.ctx.onnx_backend
+    executor: InferenceExecutor = request.app.ctx.executor
+
+    async def score_chunk(start):
+        try:
+            scores, _ = await executor.run(onnx_backend.get_rerank, query, passages[start:start + chunk_size])
+            return {"start": start, "scores": scores}
+        except Exception as e:
+            return {"start": start, "error": str(e)}
+
+    tasks = [asyncio.create_task(score_chunk(start)) for start in range(0, len(passages), chunk_size)]
+    response = await request.respond(content_type="application/x-ndjson")
+    try:
+        for task in asyncio.as_completed(tasks):
+            await response.send(jsonlib.dumps(await task) + "\n")
+    finally:
+        # 客户端提前断开时取消还没开始的块
+        for task in tasks:
+            task.cancel()
+    await response.eof()
+    rerank_logger.info(f"rerank stream passages number: {len(passages)}, chunks: {len(tasks)}")
+
+
+@app.route("/rerank_topk", methods=["POST"])
+async def rerank_topk(request):
+    """
+    只返回过滤后保留的passage：[{"index": 原始位置, "score": 分数}]，按分数从高到低排序
+
+    exact_scores 默认为true；为false时允许跳过窗口，跳过了窗口的passage返回的是分数下界，见 RerankBackend.get_rerank_topk
+    """
+    data = request.json
+    query = data.get('query')
+    passages = data.get('passages')
+    top_k = data.get('top_k', len(passages))
+    onnx_backend: RerankBackend = request.app.ctx.onnx_backend
+    executor: InferenceExecutor = request.app.ctx.executor
+    try:
+        result_data, timing = await executor.run(onnx_backend.get_rerank_topk, query, passages, top_k,
+                                                 score_threshold=data.get('score_threshold', 0.0),
+                                                 relative_threshold=data.get('relative_threshold'),
+                                                 hints=data.get('hints'),
+                                                 exact_scores=data.get('exact_scores', True))
+    except InferenceQueueFull as e:
+        return json({"msg": str(e)}, status=503)
+    rerank_logger.info(f"rerank topk passages number: {len(passages)}, top_k: {top_k}, "
+                       f"queue time: {timing['queue_time']:.4f}s, infer time: {timing['infer_time']:.4f}s")
+    return json([{"index": index, "score": score} for index, score in result_data],
+                headers={"X-Queue-Time": f"{timing['queue_time']:.4f}",
+                         "X-Infer-Time": f"{timing['infer_time']:.4f}"})
+
+
+@app.route("/health", methods=["GET"])
+async def health(request):
+    # 推理在线程池中执行，推理繁忙时健康检查也能立即返回
+    return json({"code": 200, "msg": "success", "model_path": request.app.ctx.onnx_backend.model_path,
+                 "executor": request.app.ctx.executor.stats(),
+                 "sessions": request.app.ctx.onnx_backend.session_stats(),
+                 "score_cache": request.app.ctx.onnx_backend.score_cache_stats()})
 
 
 @app.listener('before_server_start')
 async def setup_onnx_backend(app, loop):
     # app.ctx.onnx_backend = RerankAsyncBackend(model_path=LOCAL_RERANK_MODEL_PATH, use_cpu=not args.use_gpu,
     #                                           num_threads=LOCAL_RERANK_THREADS)
-    app.ctx.onnx_backend = RerankBackend(use_cpu=not args.use_gpu)
+    app.ctx.onnx_backend = RerankBackend(use_cpu=not args.use_gpu, model_variant=args.model_variant,
+                                         num_sessions=args.num_sessions, intra_op_threads=args.intra_op_threads,
+                                         pin_cores=args.pin_cores and args.workers <= 1,
+                                         core_offset=args.core_offset,
+                                         score_cache_size=args.score_cache_size,
+                                         score_cache_ttl=args.score_cache_ttl)
+    app.ctx.executor = InferenceExecutor(max_concurrency=args.infer_concurrency, max_queue=args.max_queue,
+                                         name='rerank')
+
+
+@app.listener('after_server_stop')
+async def stop_executor(app, loop):
+    app.ctx.executor.shutdown()
 
 
 if __name__ == "__main__":
@@ -18,9 +18,10 @@ if [ ! -f "rerank_server.py" ]; then
     exit 1
 fi
 
-# 启动rerank服务
+# 启动rerank服务，脚本参数原样传给rerank_server.py
+# 例如和另一个服务共用机器时绑核：./start.sh --pin_cores --core_offset 8 --num_sessions 1 --intra_op_threads 8
 echo "Starting rerank server with nohup..."
-nohup python rerank_server.py > record.log 2>&1 &
+nohup python rerank_server.py "$@" > record.log 2>&1 &
 
 # 获取后台进程的PID
 RERANK_PID=$!
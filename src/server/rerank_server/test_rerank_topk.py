@@ -0,0 +1,103 @@
+import os
+import sys
+import random
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+
+from src.server.rerank_server.rerank_backend import RerankBackend
+
+
+class StubRerankBackend(RerankBackend):
+    """
+    不加载模型的RerankBackend，passage直接是各个窗口的分数列表，
+    窗口打分就是返回窗口自己的分数，用来和全量计算的结果对比
+    """
+
+    def __init__(self):
+        self._score_cache = None
+        self.scored_windows = 0
+
+    def tokenize_preproc(self, query, passages):
+        windows, windows_idxs = [], []
+        for idx, passage in enumerate(passages):
+            for window in passage:
+                windows.append(window)
+                windows_idxs.append(idx)
+        return None, windows, windows_idxs
+
+    def _score_windows(self, query_ids, windows):
+        self.scored_windows += len(windows)
+        return list(windows)
+
+    def get_rerank(self, query, passages):
+        return [max(passage) for passage in passages]
+
+
+def full_topk(passages, top_k, score_threshold, relative_threshold):
+    scores = [max(passage) for passage in passages]
+    return [(i, scores[i]) for i in RerankBackend.filter_topk(scores, top_k, score_threshold, relative_threshold)]
+
+
+def test_relative_threshold_uses_final_scores():
+    """A的第二个窗口抬高了最高分，相对阈值要按最终的最高分过滤掉B"""
+    backend = StubRerankBackend()
+    passages = [[0.6, 0.95], [0.4]]
+    for exact_scores in (True, False):
+        result = backend.get_rerank_topk("q", passages, 5, score_threshold=0.28, relative_threshold=0.5,
+                                         exact_scores=exact_scores)
+        assert result == [(0, 0.95)]
+
+
+def test_exact_scores_match_full_scoring():
+    rng = random.Random(0)
+    backend = StubRerankBackend()
+    for _ in range(500):
+        passages = [[round(rng.random(), 3) for _ in range(rng.randint(1, 4))] for _ in range(rng.randint(1, 8))]
+        top_k = rng.randint(1, 6)
+        score_threshold = rng.choice([0.0, 0.28, 0.5, 0.9])
+        relative_threshold = rng.choice([None, 0.3, 0.5])
+        result = backend.get_rerank_topk("q", passages, top_k, score_threshold=score_threshold,
+                                         relative_threshold=relative_threshold)
+        assert result == full_topk(passages, top_k, score_threshold, relative_threshold)
+
+
+def test_skipped_windows_keep_the_same_passages():
+    """跳过窗口时保留的passage集合和全量计算一致，分数不超过最终分数"""
+    rng = random.Random(1)
+    backend = StubRerankBackend()
+    for _ in range(500):
+        passages = [[round(rng.random(), 3) for _ in range(rng.randint(1, 4))] for _ in range(rng.randint(1, 8))]
+        top_k = rng.randint(1, 6)
+        score_threshold = rng.choice([0.0, 0.28, 0.5, 0.9])
+        relative_threshold = rng.choice([None, 0.3, 0.5])
+        hints = [rng.random() for _ in passages]
+        result = backend.get_rerank_topk("q", passages, top_k, score_threshold=score_threshold,
+                                         relative_threshold=relative_threshold, hints=hints, exact_scores=False)
+        expected = full_topk(passages, top_k, score_threshold, relative_threshold)
+        expected_scores = [score for _, score in expected]
+        # 分数相同时保留哪一个可以不同，所以比较分数的多重集合
+        assert sorted(max(passages[i]) for i, _ in result) == sorted(expected_scores)
+        for i, score in result:
+            assert score <= max(passages[i])
+
+
+def test_confident_passages_skip_windows():
+    """下界已经超过 max(score_threshold, 1 - relative_threshold) 的passage不再计算后面的窗口"""
+    backend = StubRerankBackend()
+    passages = [[0.9, 0.95, 0.97, 0.99], [0.8, 0.1, 0.1], [0.2]]
+    result = backend.get_rerank_topk("q", passages, 5, score_threshold=0.28, relative_threshold=0.5,
+                                     exact_scores=False)
+    assert [i for i, _ in result] == [0, 1]
+    assert result[0][1] == 0.9
+    assert backend.scored_windows == 3
+
+
+if __name__ == "__main__":
+    test_relative_threshold_uses_final_scores()
+    test_exact_scores_match_full_scoring()
+    test_skipped_windows_keep_the_same_passages()
+    test_confident_passages_skip_windows()
+    print("all tests passed")
@@ -0,0 +1,151 @@
+import hashlib
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional
+
+
+def text_hash(text: str) -> bytes:
+    """计算文本的hash，用作缓存的key，避免在缓存里保存整段原文"""
+    return hashlib.md5(text.encode('utf-8')).digest()
+
+
+def normalize_query(query: str) -> str:
+    """归一化query用于缓存：统一全角半角、合并空白，只差空格或全角符号的问题视为同一个问题"""
+    return ' '.join(unicodedata.normalize('NFKC', query).split())
+
+
+class LRUCache:
+    """
+    线程安全的LRU缓存
+
+    max_size 是容量上限，默认每个条目记为1；传入 sizeof 时按 sizeof(value) 计算占用，
+    例如按token数限制分词缓存的内存。ttl 不为空时，超过 ttl 秒的条目视为未命中。
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_size(self, value) -> int:
+        return self.sizeof(value) if self.sizeof is not None else 1
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expire_at = entry
+            if expire_at is not None and expire_at < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value):
+        size = self._entry_size(value)
+        # 单个条目就超过上限的不缓存
+        if size > self.max_size:
+            return
+        expire_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, expire_at)
+            self._size += size
+            # 淘汰最久未使用的条目
+            while self._size > self.max_size:
+                self._pop(next(iter(self._data)))
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._pop(key)
+
+    def _pop(self, key):
+        value, _ = self._data.pop(key)
+        self._size -= self._entry_size(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"entries": len(self._data), "size": self._size, "max_size": self.max_size,
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hit_rate, 4)}
+
+
+class TokenCache:
+    """
+    分词结果缓存，key为 (tokenizer名称, 文本hash)
+
+    缓存的是不带特殊token的input_ids，切分时的token计数、embedding推理、rerank拼接
+    都可以从同一份结果得到，不用对同一段文本反复分词。内存按缓存的token总数限制。
+    """
+
+    def __init__(self, tokenizer, max_tokens: int = 8 * 1024 * 1024):
+        self.tokenizer = tokenizer
+        self.name = getattr(tokenizer, 'name_or_path', '')
+        self._cache = LRUCache(max_tokens, sizeof=len)
+
+    def encode(self, text: str) -> List[int]:
+        return self.encode_batch([text])[0]
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        """批量获取分词结果，未命中的文本合并成一次分词器调用"""
+        return [list(ids) for ids in self.encode_arrays(texts)]
+
+    def encode_arrays(self, texts: List[str]) -> List[array]:
+        """和 encode_batch 相同，但直接返回缓存中的array，调用方只读不改，省去转成list的开销"""
+        results = [None] * len(texts)
+        miss_idx = []
+        miss_keys = []
+        for i, text in enumerate(texts):
+            key = (self.name, text_hash(text))
+            ids = self._cache.get(key)
+            if ids is None:
+                miss_idx.append(i)
+                miss_keys.append(key)
+            else:
+                results[i] = ids
+        if miss_idx:
+            encoded = self.tokenizer([texts[i] for i in miss_idx], add_special_tokens=False,
+                                     truncation=False, padding=False)['input_ids']
+            for i, key, ids in zip(miss_idx, miss_keys, encoded):
+                # 用array保存，比list[int]省内存
+                ids = array('i', ids)
+                self._cache.put(key, ids)
+                results[i] = ids
+        return results
+
+    def num_tokens(self, text: str, add_special_tokens: bool = True) -> int:
+        num = len(self.encode_arrays([text])[0])
+        if add_special_tokens:
+            num += self.tokenizer.num_special_tokens_to_add(pair=False)
+        return num
+
+    def stats(self) -> dict:
+        return self._cache.stats()
@@ -0,0 +1,28 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+# 二进制响应支持的编码方式，统一使用小端序
+BINARY_DTYPES = {'float32': '<f4', 'float16': '<f2'}
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+
+def encode_embeddings(embeddings: np.ndarray, encoding: str) -> Tuple[bytes, Dict[str, str]]:
+    """
+    把 (n, dim) 的向量矩阵编码为小端序的原始字节
+
+    返回 (body, headers)，形状和数据类型放在响应头 X-Embedding-Shape / X-Embedding-Dtype 中。
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=BINARY_DTYPES[encoding])
+    if embeddings.ndim != 2:
+        embeddings = embeddings.reshape(len(embeddings), -1)
+    headers = {'X-Embedding-Shape': f'{embeddings.shape[0]},{embeddings.shape[1]}',
+               'X-Embedding-Dtype': encoding}
+    return embeddings.tobytes(), headers
+
+
+def decode_embeddings(body: bytes, headers) -> np.ndarray:
+    """按响应头中的形状和数据类型把原始字节解码为float32矩阵"""
+    rows, dim = (int(x) for x in headers['X-Embedding-Shape'].split(','))
+    dtype = BINARY_DTYPES[headers['X-Embedding-Dtype']]
+    return np.frombuffer(body, dtype=dtype).reshape(rows, dim).astype(np.float32)
@@ -3,6 +3,7 @@ from functools import wraps
 
 import tiktoken  # 添加这行导入
 from src.utils.log_handler import debug_logger, embed_logger, rerank_logger
+from src.utils.cache_utils import TokenCache
 from src.configs.configs import DEFAULT_MODEL_PATH, KB_SUFFIX, EMBED_MODEL_PATH, RERANK_MODEL_PATH
 from sanic.request import Request
 from sanic.exceptions import BadRequest
@@ -181,6 +182,9 @@ def clear_string(str):
 embedding_tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_PATH)
 rerank_tokenizer = AutoTokenizer.from_pretrained(RERANK_MODEL_PATH)
 llm_tokenizer = AutoTokenizer.from_pretrained(DEFAULT_MODEL_PATH)
+# 分词结果缓存，切分文档时同一段文本会被反复计算token数
+embedding_token_cache = TokenCache(embedding_tokenizer)
+rerank_token_cache = TokenCache(rerank_tokenizer)
 
 def num_tokens(text: str) -> int:
     """Return the number of tokens in a string."""
@@ -188,11 +192,11 @@ def num_tokens(text: str) -> int:
 
 def num_tokens_embed(text: str) -> int:
     """返回字符串的Token数量"""
-    return len(embedding_tokenizer.encode(text, add_special_tokens=True))
+    return embedding_token_cache.num_tokens(text, add_special_tokens=True)
 
 def num_tokens_rerank(text: str) -> int:
     """Return the number of tokens in a string."""
-    return len(rerank_tokenizer.encode(text, add_special_tokens=True))
+    return rerank_token_cache.num_tokens(text, add_special_tokens=True)
 
 def fast_estimate_file_char_count(file_path):
     """
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from src.utils.log_handler import debug_logger
+
+
+class InferenceQueueFull(Exception):
+    """排队的推理请求超过上限"""
+    pass
+
+
+class InferenceExecutor:
+    """
+    有界推理线程池
+
+    把阻塞的onnx推理（连同分词）放到线程池里执行，事件循环可以继续接收新连接、响应健康检查。
+    max_concurrency 是同时执行的推理数，大于1时请求N+1的分词可以和请求N的推理重叠；
+    max_queue 是允许排队等待的请求数，超过时直接抛出 InferenceQueueFull。
+    每次调用都会统计排队时间和推理时间。
+    """
+
+    def __init__(self, max_concurrency: int = 2, max_queue: Optional[int] = None, name: str = 'inference'):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        # 已提交但还未开始执行的请求数
+        self.queued = 0
+        # 正在执行的请求数
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_queue_time = 0.0
+        self.total_infer_time = 0.0
+        self.max_queue_time = 0.0
+
+    async def run(self, func, *args, **kwargs):
+        """
+        在线程池中执行 func(*args, **kwargs)
+
+        返回 (result, timing)，timing 包含 queue_time（排队时间）、infer_time（执行时间）
+        和 start_time（开始执行的 perf_counter 时间戳），单位都是秒。
+        """
+        with self._lock:
+            if self.max_queue is not None and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise InferenceQueueFull(f"inference queue is full: {self.queued} requests waiting")
+            self.queued += 1
+        submit_time = time.perf_counter()
+
+        def _call():
+            start_time = time.perf_counter()
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return func(*args, **kwargs), start_time
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+        loop = asyncio.get_running_loop()
+        try:
+            result, start_time = await loop.run_in_executor(self._executor, _call)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        end_time = time.perf_counter()
+        timing = {'queue_time': start_time - submit_time,
+                  'infer_time': end_time - start_time,
+                  'start_time': start_time}
+        with self._lock:
+            self.completed += 1
+            self.total_queue_time += timing['queue_time']
+            self.total_infer_time += timing['infer_time']
+            self.max_queue_time = max(self.max_queue_time, timing['queue_time'])
+        if self.queued > self.max_concurrency:
+            debug_logger.info(f"inference backlog: {self.queued} queued, {self.running} running")
+        return result, timing
+
+    def stats(self) -> dict:
+        with self._lock:
+            completed = max(self.completed, 1)
+            return {"max_concurrency": self.max_concurrency, "max_queue": self.max_queue,
+                    "queued": self.queued, "running": self.running,
+                    "completed": self.completed, "failed": self.failed, "rejected": self.rejected,
+                    "avg_queue_time": round(self.total_queue_time / completed, 4),
+                    "max_queue_time": round(self.max_queue_time, 4),
+                    "avg_infer_time": round(self.total_infer_time / completed, 4)}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
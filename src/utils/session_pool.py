@@ -0,0 +1,131 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from onnxruntime import InferenceSession, SessionOptions, GraphOptimizationLevel
+
+from src.utils.log_handler import debug_logger
+
+# 自动配置时每个会话分到的核数，bert-base规模的模型单会话超过8个线程后加速很有限
+DEFAULT_THREADS_PER_SESSION = 8
+
+
+def available_cores() -> List[int]:
+    """当前进程可用的CPU核（考虑taskset/cgroup的限制）"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class SessionPool:
+    """
+    onnx推理会话池
+
+    原来所有推理线程共用一个 intra_op_num_threads=0 的会话，每次run都会在全部核上起线程，
+    多个线程同时推理时互相抢核。这里创建 num_sessions 个会话，把可用核平均分给各个会话，
+    每个会话的线程数等于分到的核数。pin_cores 为True时把会话的线程绑定到各自的核上，
+    从可用核中的第 core_offset 个开始分配；默认不绑核，同一台机器上的多个服务进程
+    （embedding、rerank、多个worker）绑核时需要给每个进程指定不重叠的 core_offset。
+    推理时通过 acquire() 借出一个空闲会话，用完归还，并统计每个会话的调用次数和忙碌时间。
+
+    num_sessions / intra_op_threads 为空时自动配置：GPU只用1个会话，
+    CPU按每个会话 DEFAULT_THREADS_PER_SESSION 个核切分。每个会话都会加载一份模型权重。
+    """
+
+    def __init__(self, model_path: str, providers: List[str], num_sessions: Optional[int] = None,
+                 intra_op_threads: Optional[int] = None, pin_cores: bool = False, core_offset: int = 0,
+                 name: str = 'onnx'):
+        self.model_path = model_path
+        self.name = name
+        use_gpu = 'CUDAExecutionProvider' in providers
+        cores = available_cores()
+        if num_sessions is None:
+            num_sessions = 1 if use_gpu else max(1, len(cores) // DEFAULT_THREADS_PER_SESSION)
+        if intra_op_threads is None:
+            intra_op_threads = max(1, len(cores) // num_sessions)
+        self.size = num_sessions
+        self.intra_op_threads = intra_op_threads
+        self.core_offset = core_offset
+        # 从 core_offset 开始的核数不够平分时不绑核，避免多个会话绑到同一批核上
+        pin_range = cores[core_offset:]
+        self.pin_cores = pin_cores and not use_gpu and num_sessions * intra_op_threads <= len(pin_range)
+
+        self._sessions = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._created_at = time.monotonic()
+        self.waiting = 0
+        for i in range(num_sessions):
+            session_cores = pin_range[i * intra_op_threads:(i + 1) * intra_op_threads] if self.pin_cores else []
+            session = InferenceSession(model_path, sess_options=self._session_options(session_cores),
+                                       providers=providers)
+            self._sessions.append({'session': session, 'cores': session_cores, 'calls': 0,
+                                   'busy_time': 0.0, 'in_use': False})
+            self._idle.put(i)
+        debug_logger.info(f"SessionPool[{name}]: {num_sessions} sessions x {intra_op_threads} threads, "
+                          f"pin_cores: {self.pin_cores}, core_offset: {core_offset}, available cores: {len(cores)}")
+
+    def _session_options(self, cores: List[int]) -> SessionOptions:
+        sess_options = SessionOptions()
+        sess_options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = self.intra_op_threads
+        # 顺序执行模式下inter_op线程池不会被使用
+        sess_options.inter_op_num_threads = 1
+        if cores and self.intra_op_threads > 1:
+            # 配置的是除调用线程外的 intra_op_threads-1 个工作线程，核编号从1开始
+            affinities = ';'.join(str(core + 1) for core in cores[1:])
+            sess_options.add_session_config_entry('session.intra_op_thread_affinities', affinities)
+        if self.size > 1:
+            # 多个会话时关闭线程自旋等待，空闲的会话不占用CPU
+            sess_options.add_session_config_entry('session.intra_op.allow_spinning', '0')
+        return sess_options
+
+    @property
+    def session(self) -> InferenceSession:
+        """用于读取输入输出等元信息，推理请使用 acquire()"""
+        return self._sessions[0]['session']
+
+    def get_inputs(self):
+        return self.session.get_inputs()
+
+    def get_outputs(self):
+        return self.session.get_outputs()
+
+    @contextmanager
+    def acquire(self):
+        """借出一个空闲会话，所有会话都在使用时阻塞等待"""
+        with self._lock:
+            self.waiting += 1
+        idx = self._idle.get()
+        with self._lock:
+            self.waiting -= 1
+        entry = self._sessions[idx]
+        entry['in_use'] = True
+        start_time = time.perf_counter()
+        try:
+            yield entry['session']
+        finally:
+            with self._lock:
+                entry['calls'] += 1
+                entry['busy_time'] += time.perf_counter() - start_time
+                entry['in_use'] = False
+            self._idle.put(idx)
+
+    def run(self, output_names, input_feed):
+        with self.acquire() as session:
+            return session.run(output_names, input_feed)
+
+    def stats(self) -> dict:
+        uptime = max(time.monotonic() - self._created_at, 1e-9)
+        with self._lock:
+            sessions = [{'calls': entry['calls'], 'busy_time': round(entry['busy_time'], 4),
+                         'utilization': round(entry['busy_time'] / uptime, 4), 'in_use': entry['in_use'],
+                         'cores': f"{entry['cores'][0]}-{entry['cores'][-1]}" if entry['cores'] else None}
+                        for entry in self._sessions]
+            return {'model_path': self.model_path, 'num_sessions': self.size,
+                    'intra_op_threads': self.intra_op_threads, 'pin_cores': self.pin_cores,
+                    'core_offset': self.core_offset,
+                    'waiting': self.waiting, 'sessions': sessions}